@@ -6,19 +6,29 @@ Created on Mon Jul  7 18:02:55 2025
 """
 
 # streamlit_app.py
+import time
+_T0 = time.perf_counter()  # inicio del script: se mide hasta el primer render (login / saldo)
+
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.ticker as mtick
 import io
-import dropbox
 import numpy as np
+import openpyxl
 import re
 import unicodedata
+import functools
+import inspect
+import sys
+from collections import OrderedDict, deque
 import pandas as pd
 import math
 import base64
+import hashlib
 import json
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 
@@ -27,26 +37,71 @@ import json
 # 1) Configuración de la página
 st.set_page_config(page_title="Dashboard Mayoristas", layout="wide")
 
-# 2) Inicializa Dropbox
+# 2) Dropbox y Anthropic se crean bajo demanda (primer uso) y se comparten en el proceso:
+#    la pantalla de login no paga ni la importación de los SDK ni la creación de clientes.
 cfg_dbx = st.secrets["dropbox"]
-dbx = dropbox.Dropbox(
-    app_key=cfg_dbx["app_key"],
-    app_secret=cfg_dbx["app_secret"],
-    oauth2_refresh_token=cfg_dbx["refresh_token"],
-)
 
-# 2.1) Inicializa cliente de Anthropic (Claude) para leer comprobantes con visión.
-#      Si no hay API key configurada, anthropic_client queda en None y el flujo
-#      cae a revisión manual del admin (no rompe la app).
-try:
-    import anthropic
-    _anthropic_key = st.secrets.get("anthropic", {}).get("api_key", "").strip()
-    if _anthropic_key and _anthropic_key != "PEGA_AQUI_TU_API_KEY":
-        anthropic_client = anthropic.Anthropic(api_key=_anthropic_key)
-    else:
-        anthropic_client = None
-except Exception:
-    anthropic_client = None
+
+@st.cache_resource(show_spinner=False)
+def get_dbx() -> "dropbox.Dropbox":
+    """Un solo cliente de Dropbox por proceso (reutiliza conexión y token)."""
+    import dropbox
+    return dropbox.Dropbox(
+        app_key=cfg_dbx["app_key"],
+        app_secret=cfg_dbx["app_secret"],
+        oauth2_refresh_token=cfg_dbx["refresh_token"],
+    )
+
+
+# 2.1) Cliente de Anthropic (Claude) para leer comprobantes con visión.
+#      Si no hay API key configurada queda en None y el flujo cae a revisión manual
+#      del admin (no rompe la app).
+@st.cache_resource(show_spinner=False)
+def _anthropic_client():
+    try:
+        _anthropic_key = st.secrets.get("anthropic", {}).get("api_key", "").strip()
+        if not _anthropic_key or _anthropic_key == "PEGA_AQUI_TU_API_KEY":
+            return None
+        import anthropic
+        return anthropic.Anthropic(api_key=_anthropic_key)
+    except Exception:
+        return None
+
+
+# 2.2) Métricas del proceso (tiempos de arranque, etc.): últimas N muestras por nombre.
+@st.cache_resource(show_spinner=False)
+def _metricas_store() -> dict:
+    return {"lock": threading.Lock(), "series": {}, "primer_render": True, "comprobantes": deque(maxlen=50)}
+
+
+def _registrar_metrica(nombre: str, valor: float, maxlen: int = 200) -> None:
+    store = _metricas_store()
+    with store["lock"]:
+        store["series"].setdefault(nombre, deque(maxlen=maxlen)).append(float(valor))
+
+
+def _reporte_metricas() -> pd.DataFrame:
+    store = _metricas_store()
+    with store["lock"]:
+        series = {k: list(v) for k, v in store["series"].items()}
+    rows = [
+        {"métrica": k, "n": len(v), "última": round(v[-1], 3),
+         "mediana": round(float(np.median(v)), 3), "p95": round(float(np.percentile(v, 95)), 3)}
+        for k, v in sorted(series.items()) if v
+    ]
+    return pd.DataFrame(rows, columns=["métrica", "n", "última", "mediana", "p95"])
+
+
+def _marcar_render(etapa: str) -> None:
+    """Registra el tiempo desde el inicio del script hasta esta etapa."""
+    dt = time.perf_counter() - _T0
+    store = _metricas_store()
+    with store["lock"]:
+        primera, store["primer_render"] = store["primer_render"], False
+    _registrar_metrica(f"render {etapa} (s)", dt)
+    if primera:
+        _registrar_metrica("render en frío (s)", dt)
+    print(f"[arranque] {etapa} en {dt:.2f}s" + (" (proceso nuevo)" if primera else ""))
 
 
 def get_base_folder() -> str:
@@ -60,11 +115,526 @@ def get_base_folder() -> str:
 
 
 
-@st.cache_data
-def load_data(sheet_name: str) -> pd.DataFrame:
-    _, res = dbx.files_download(cfg_dbx["remote_path"])
-    df = pd.read_excel(io.BytesIO(res.content), sheet_name=sheet_name)
+# ============== Caché compartido (todas las sesiones) con tope de memoria ==============
+# Bytes descargados y DataFrames parseados viven en UN caché por proceso con presupuesto
+# de memoria (st.secrets["cache"]["max_mb"], 512 MB por defecto). Al pasarse, se expulsa lo
+# usado hace más tiempo. Las sesiones reciben referencias de solo lectura, no copias: quien
+# vaya a modificar un DF que salió de load_data, load_consignaciones, load_ingresos_con_id o
+# _try_download_excel debe hacer .copy() antes (los pocos sitios que editan ya lo hacen).
+CACHE_MAX_MB = int(st.secrets.get("cache", {}).get("max_mb", 512))
+
+
+def _tamano(value) -> int:
+    """Bytes aproximados que ocupa un valor cacheado."""
+    if value is None:
+        return 0
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (tuple, list)):
+        return sum(_tamano(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_tamano(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+class _CacheLRU:
+    """Caché LRU con presupuesto en bytes y contadores de aciertos/fallos/expulsiones."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict = OrderedDict()  # llave -> (valor, bytes)
+        self._lock = threading.Lock()
+        self._cargando: dict = {}  # llave -> Lock: una sola carga simultánea por llave
+
+    def peek(self, key):
+        """Valor si está en caché (sin contarlo como acierto ni cargarlo)."""
+        with self._lock:
+            hit = self._data.get(key)
+        return None if hit is None else hit[0]
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            carga = self._cargando.setdefault(key, threading.Lock())
+        with carga:
+            with self._lock:
+                if key in self._data:  # otra sesión lo cargó mientras esperábamos
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return self._data[key][0]
+                self.misses += 1
+            try:
+                value = loader()
+                self.put(key, value)
+            finally:
+                with self._lock:
+                    self._cargando.pop(key, None)
+        return value
+
+    def put(self, key, value) -> None:
+        size = _tamano(value)
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._data) > 1:
+                _, (_, sz) = self._data.popitem(last=False)
+                self.bytes -= sz
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entradas": len(self._data),
+                "MB usados": round(self.bytes / 1e6, 2),
+                "MB tope": round(self.max_bytes / 1e6, 2),
+                "aciertos": self.hits,
+                "fallos": self.misses,
+                "expulsiones": self.evictions,
+                "% aciertos": round(100 * self.hits / total, 1) if total else 0.0,
+            }
+
+
+@st.cache_resource(show_spinner=False)
+def _cache_compartido() -> _CacheLRU:
+    return _CacheLRU(CACHE_MAX_MB * 1024 * 1024)
+
+
+def _memo_compartido(fn):
+    """
+    Como @st.cache_data, pero en el caché LRU compartido y devolviendo referencias. La llave
+    lleva todos los argumentos con sus defaults: f(a, b) y f(a, b, None) son la misma entrada.
+    """
+    firma = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        ba = firma.bind(*args, **kwargs)
+        ba.apply_defaults()
+        return _cache_compartido().get_or_load((fn.__name__, *ba.args), lambda: fn(*ba.args))
+    return wrapper
+
+
+# ============== Archivos de Dropbox validados por revisión ==============
+# Antes de reutilizar un DataFrame cacheado se pregunta a Dropbox por la metadata del
+# archivo (files_get_metadata, barato) y se compara su content_hash: solo se vuelve a
+# descargar/parsear lo que realmente cambió. La metadata se memoriza unos segundos para
+# que un mismo rerun (o reruns seguidos) no repita la consulta por cada loader.
+_META_TTL_S = 10
+
+
+@st.cache_resource(show_spinner=False)
+def _dropbox_store() -> dict:
+    """Estado compartido por todas las sesiones: metadata reciente y estado de carga por hoja."""
+    return {"lock": threading.Lock(), "meta": {}, "incremental": {}, "memoria": {}, "log": None}
+
+
+def _es_no_encontrado(e: Exception) -> bool:
+    """True si el ApiError de Dropbox es 'la ruta no existe'."""
+    err = getattr(e, "error", None)
+    try:
+        return err.is_path() and err.get_path().is_not_found()
+    except Exception:
+        return False
+
+
+def _remember_meta(path: str, md) -> None:
+    """Registra la metadata vigente de un archivo (p.ej. la que devuelve files_upload)."""
+    store = _dropbox_store()
+    with store["lock"]:
+        store["meta"][path.lower()] = (time.monotonic(), md)
+
+
+def _olvidar_metadata() -> None:
+    """Fuerza a que la próxima lectura vuelva a validar contra Dropbox (no borra datos)."""
+    store = _dropbox_store()
+    with store["lock"]:
+        store["meta"].clear()
+
+
+def _dropbox_meta(path: str, fresh: bool = False):
+    """FileMetadata vigente del archivo, o None si no existe."""
+    store = _dropbox_store()
+    key = path.lower()
+    with store["lock"]:
+        hit = store["meta"].get(key)
+    if hit is not None and not fresh and time.monotonic() - hit[0] < _META_TTL_S:
+        return hit[1]
+    import dropbox
+    try:
+        md = get_dbx().files_get_metadata(path)
+        if not isinstance(md, dropbox.files.FileMetadata):
+            md = None
+    except dropbox.exceptions.ApiError as e:
+        if not _es_no_encontrado(e):
+            raise
+        md = None
+    _remember_meta(path, md)
+    return md
+
+
+def _dropbox_version(path: str) -> str | None:
+    """Versión del contenido (content_hash) para usar como llave de caché; None si no existe."""
+    md = _dropbox_meta(path)
+    return None if md is None else (md.content_hash or md.rev)
+
+
+def _metadata_por_listado(paths: list[str]) -> None:
+    """
+    Revalida con un listado por carpeta la metadata vencida de varios archivos, en vez de un
+    get_metadata por archivo. Los que no aparecen en el listado de SU carpeta no existen.
+    """
+    import dropbox
+    store = _dropbox_store()
+    now = time.monotonic()
+    with store["lock"]:
+        vencidos = [
+            p for p in paths
+            if p.lower() not in store["meta"] or now - store["meta"][p.lower()][0] >= _META_TTL_S
+        ]
+    por_carpeta: dict[str, list[str]] = {}
+    for p in vencidos:
+        por_carpeta.setdefault(p.rsplit("/", 1)[0].lower(), []).append(p)
+    for grupo in por_carpeta.values():
+        if len(grupo) < 2:
+            continue  # con uno solo basta el get_metadata normal
+        res = get_dbx().files_list_folder(grupo[0].rsplit("/", 1)[0])
+        entries = list(res.entries)
+        while res.has_more:
+            res = get_dbx().files_list_folder_continue(res.cursor)
+            entries.extend(res.entries)
+        vistos = set()
+        for ent in entries:
+            if isinstance(ent, dropbox.files.FileMetadata):
+                _remember_meta(ent.path_display, ent)
+                vistos.add(ent.path_display.lower())
+        for p in grupo:
+            if p.lower() not in vistos:
+                _remember_meta(p, None)
+
+
+def _dropbox_bytes(path: str, version: str | None = None, cachear: bool = True) -> tuple[str, bytes] | None:
+    """
+    Bytes del archivo en la versión pedida (content_hash o rev: la misma llave con que se
+    memoriza lo que se va a parsear) o, sin `version`, en la vigente. Solo descarga si esa
+    versión no está ya en memoria. Devuelve (version, bytes) o None si el archivo (o esa
+    versión) ya no existe. Con cachear=False los bytes no se guardan en el caché compartido.
+    """
+    cache = _cache_compartido()
+    key = ("raw", path.lower())
+    hit = cache.peek(key)
+    if hit is not None and version is not None and hit[0] == version:
+        return cache.get_or_load(key, lambda: hit)  # cuenta el acierto y lo marca como reciente
+    md = _dropbox_meta(path)
+    if version is not None and (md is None or (md.content_hash or md.rev) != version):
+        md = _dropbox_meta(path, fresh=True)  # la metadata memorizada puede ir atrasada
+    if md is None:
+        return None
+    vigente = md.content_hash or md.rev
+    if version is None:
+        version = vigente
+        if hit is not None and hit[0] == version:
+            return cache.get_or_load(key, lambda: hit)
+    rev = md.rev if version == vigente else _rev_de_version(path, version)
+    if rev is None:
+        return None
+    _, res = get_dbx().files_download(f"rev:{rev}")
+    if cachear and version == vigente:
+        cache.put(key, (version, res.content))  # reemplaza la versión anterior de ese archivo
+    return version, res.content
+
+
+def _rev_de_version(path: str, version: str) -> str | None:
+    """rev de una versión anterior del archivo (si el archivo cambió mientras se cargaba)."""
+    import dropbox
+    try:
+        res = get_dbx().files_list_revisions(path, limit=10)
+    except dropbox.exceptions.ApiError as e:
+        if not _es_no_encontrado(e):
+            raise
+        return None
+    for md in res.entries:
+        if version in (md.content_hash, md.rev):
+            return md.rev
+    return None
+
+
+def _dbx_upload(data: bytes, path: str):
+    """Sube (sobrescribe) a Dropbox y registra la nueva versión para que las lecturas la vean ya."""
+    import dropbox
+    md = get_dbx().files_upload(data, path, mode=dropbox.files.WriteMode.overwrite)
+    _remember_meta(path, md)
+    return md
+
+
+# ============== Snapshot columnar local (Parquet) ==============
+# Cada hoja/archivo ya parseado se guarda en disco como Parquet, etiquetado con la versión
+# de Dropbox (content_hash) de la que salió. Mientras esa versión no cambie, un arranque en
+# frío (o un reinicio del servidor) lee el Parquet en vez de volver a parsear el xlsx.
+try:
+    import pyarrow  # motor de Parquet (opcional: sin él no hay snapshots)
+    import pyarrow.parquet
+    _HAS_ARROW = True
+except ImportError:
+    _HAS_ARROW = False
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".dash_cache", "snapshots")
+_SNAPSHOT_FORMATO = 4  # subirlo si cambia la forma en que se normalizan las hojas
+
+
+def _snapshot_base(path: str, sheet_name: str) -> str:
+    base = re.sub(r"[^A-Za-z0-9._-]", "_", f"{path.lower()}__{sheet_name}")
+    return os.path.join(SNAPSHOT_DIR, f"{base}__v{_SNAPSHOT_FORMATO}")
+
+
+def _snapshot_file(path: str, sheet_name: str, version: str) -> str:
+    tag = re.sub(r"[^A-Za-z0-9]", "", str(version))[:24]
+    return f"{_snapshot_base(path, sheet_name)}__{tag}.parquet"
+
 
+def _snapshot_read(path: str, sheet_name: str, version: str, columns: list[str] | None = None) -> pd.DataFrame | None:
+    """Lee el snapshot de esa versión (solo las columnas pedidas). None si no hay."""
+    if not _HAS_ARROW:
+        return None
+    fpath = _snapshot_file(path, sheet_name, version)
+    if not os.path.exists(fpath):
+        return None
+    try:
+        if columns is not None:
+            disponibles = pyarrow.parquet.read_schema(fpath).names
+            columns = [c for c in columns if c in disponibles]
+        return pd.read_parquet(fpath, columns=columns)
+    except Exception as e:
+        print(f"⚠️ Snapshot ilegible, se ignora ({fpath}): {e}")
+        return None
+
+
+def _columnas_mixtas(df: pd.DataFrame) -> list:
+    """Columnas de texto con tipos mezclados (p.ej. Orden 123 y 'A-9') que Arrow no acepta tal cual."""
+    mixtas = []
+    for c in df.columns[df.dtypes == object]:
+        try:
+            pyarrow.array(df[c], from_pandas=True)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            mixtas.append(c)
+    return mixtas
+
+
+def _arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Columnas de texto con tipos mezclados pasan a texto (los vacíos se conservan). Modifica el DF."""
+    if not _HAS_ARROW:
+        return df
+    for c in _columnas_mixtas(df):
+        df[c] = df[c].map(lambda v: v if pd.isna(v) else str(v))
+    return df
+
+
+def _snapshot_write(path: str, sheet_name: str, version: str, df: pd.DataFrame, texto_mixto: bool = False) -> pd.DataFrame:
+    """
+    Guarda el snapshot de esa versión y borra los de versiones anteriores. Devuelve el DF tal como
+    quedó guardado, para que la carga en frío y la del snapshot coincidan. Con texto_mixto=True
+    (hojas de solo lectura, como el histórico) las columnas mezcladas pasan a texto; sin él
+    (archivos que se vuelven a subir a Dropbox) el DF no se toca y, si Parquet no lo acepta tal
+    cual, simplemente no hay snapshot.
+    """
+    if not _HAS_ARROW or not all(isinstance(c, str) for c in df.columns):
+        return df
+    try:
+        if texto_mixto:
+            df = _arrow_safe(df)
+        elif _columnas_mixtas(df):
+            return df
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        fpath = _snapshot_file(path, sheet_name, version)
+        tmp = f"{fpath}.{threading.get_ident()}.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, fpath)
+        base = os.path.basename(_snapshot_base(path, sheet_name)) + "__"
+        for old in os.listdir(SNAPSHOT_DIR):
+            if old.startswith(base) and old.endswith(".parquet") and old != os.path.basename(fpath):
+                os.remove(os.path.join(SNAPSHOT_DIR, old))
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar el snapshot de {path} [{sheet_name}]: {e}")
+    return df
+
+
+def load_data(sheet_name: str, columns: list[str] | None = None) -> pd.DataFrame:
+    path = cfg_dbx["remote_path"]
+    version = _dropbox_version(path)
+    if version is None:
+        raise FileNotFoundError(f"No existe el histórico en Dropbox: {path}")
+    return _load_sheet(path, version, sheet_name, tuple(columns) if columns else None)
+
+
+@_memo_compartido
+def _load_sheet(path: str, version: str, sheet_name: str, columns: tuple | None = None) -> pd.DataFrame:
+    """
+    Devuelve la hoja pedida en esa versión del libro (una vez por hoja, versión y columnas).
+    Orden: snapshot Parquet local -> si no hay, descarga (compartida por todas las hojas),
+    parsea SOLO esa hoja, normaliza y deja el snapshot para la próxima vez.
+    """
+    cols = list(columns) if columns else None
+    df = _snapshot_read(path, sheet_name, version, cols)
+    if df is not None:
+        return df
+    if cols is not None:
+        # La hoja completa queda cacheada por su cuenta: es la base de la próxima carga incremental
+        df = _load_sheet(path, version, sheet_name)
+        return df[[c for c in cols if c in df.columns]]
+
+    hit = _dropbox_bytes(path, version)
+    if hit is None:
+        raise FileNotFoundError(f"El histórico {path} ya no está en Dropbox en la versión {version}")
+    df = _cargar_hoja_historico(path, version, sheet_name, hit[1])
+    return _snapshot_write(path, sheet_name, version, df, texto_mixto=True)  # el histórico solo se lee
+
+
+# ============== Lector en streaming del histórico ==============
+# "streaming": openpyxl read_only + iter_rows(values_only=True), solo con las columnas que
+# usa el dashboard y armando columnas ya tipadas (menos memoria pico y menos tiempo de parseo).
+# "pandas": pd.read_excel de la hoja completa (modo anterior).
+HISTORICO_LECTOR = "streaming"
+HIST_COLS = ["Fecha de Carga", "Fecha", "Tipo", "Monto", "Motivo", "Orden", "Nombre del producto", "TRM"]
+HIST_COLS_EXTRA = {
+    "1444 - Maria Moises COP": ["Descripcion", "Egreso_extra_COP", "GMF_4x1000_COP"],
+}
+_HIST_FECHAS = {"Fecha de Carga", "Fecha"}
+_HIST_NUMEROS = {"Monto", "TRM", "Egreso_extra_COP", "GMF_4x1000_COP"}
+
+
+# Carga incremental: el histórico solo crece (el generador agrega lotes por 'Fecha de Carga').
+# Por hoja se recuerda cuántas filas se cargaron, la 'Fecha de Carga' máxima y una huella de
+# esas filas; si el libro cambió pero esas filas siguen idénticas, solo se arma la cola nueva.
+HISTORICO_INCREMENTAL = True
+
+
+def _cargar_hoja_historico(path: str, version: str, sheet_name: str, content: bytes) -> pd.DataFrame:
+    """Lee y normaliza una hoja del histórico; incremental sobre la versión anterior si se puede."""
+    if HISTORICO_LECTOR == "streaming":
+        try:
+            return _cargar_hoja_streaming(path, version, sheet_name, content)
+        except Exception as e:
+            print(f"⚠️ Lector streaming falló en '{sheet_name}', se usa pd.read_excel: {e}")
+    df = pd.read_excel(io.BytesIO(content), sheet_name=sheet_name)
+    return _compactar_historico(sheet_name, _normalizar_hoja(sheet_name, df))
+
+
+def _cargar_hoja_streaming(path: str, version: str, sheet_name: str, content: bytes) -> pd.DataFrame:
+    columns = HIST_COLS + HIST_COLS_EXTRA.get(sheet_name, [])
+    store = _dropbox_store()
+    key = (path.lower(), sheet_name)
+    with store["lock"]:
+        prev = store["incremental"].get(key)
+    # La hoja anterior se guarda como referencia débil (no la retiene): si el caché ya la
+    # expulsó y ninguna sesión la tiene, simplemente se hace la carga completa.
+    base = None
+    if HISTORICO_INCREMENTAL and prev is not None and prev["version"] != version:
+        base = prev["df"]()
+
+    df = None
+    if base is not None and len(base) == prev["n_filas"]:
+        cola, info = _leer_hoja_streaming(content, sheet_name, columns, desde=prev["n_filas"])
+        cola = _normalizar_hoja(sheet_name, cola)
+        fc_cola = cola["Fecha de Carga"].min() if "Fecha de Carga" in cola.columns and not cola.empty else None
+        solo_agrega = (
+            info["digest_prefijo"] == prev["digest"]
+            and list(cola.columns) == list(base.columns)
+            and not (pd.notna(fc_cola) and pd.notna(prev["max_fc"]) and fc_cola < prev["max_fc"])
+        )
+        if solo_agrega:
+            # infer_objects: mismos tipos que daría leer el libro completo de una vez
+            df = (
+                _compactar_historico(sheet_name, pd.concat([base, cola], ignore_index=True).infer_objects())
+                if not cola.empty else base.copy()
+            )
+            print(f"[histórico {sheet_name}] incremental: +{len(cola)} filas sobre {prev['n_filas']}")
+        else:
+            print(f"[histórico {sheet_name}] cambiaron filas anteriores -> recarga completa")
+
+    if df is None:
+        df, info = _leer_hoja_streaming(content, sheet_name, columns)
+        df = _compactar_historico(sheet_name, _normalizar_hoja(sheet_name, df))
+
+    with store["lock"]:
+        store["incremental"][key] = {
+            "version": version,
+            "n_filas": info["n_filas"],
+            "digest": info["digest"],
+            "max_fc": df["Fecha de Carga"].max() if "Fecha de Carga" in df.columns else None,
+            "df": weakref.ref(df),
+        }
+    return df
+
+
+def _leer_hoja_streaming(content: bytes, sheet_name: str, columns: list[str], desde: int = 0):
+    """
+    Recorre la hoja fila a fila en modo solo-lectura y guarda ÚNICAMENTE las columnas pedidas
+    (las que no existan en la hoja simplemente no aparecen, igual que con pd.read_excel).
+    Fechas y montos salen ya convertidos; las filas totalmente vacías se ignoran.
+    Con `desde`=N solo arma las filas a partir de la N-ésima; las anteriores solo se resumen
+    en una huella. Devuelve (df, info) con info = {n_filas, digest, digest_prefijo}.
+    """
+    wb = openpyxl.load_workbook(io.BytesIO(content), read_only=True, data_only=True)
+    try:
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        idx: dict[str, int] = {}
+        for i, h in enumerate(header):
+            h = None if h is None else str(h).strip()
+            if h in columns and h not in idx:
+                idx[h] = i
+        huella = hashlib.blake2b(repr(sorted(idx.items())).encode(), digest_size=16)
+        digest_prefijo = huella.hexdigest() if desde == 0 else None
+        valores: dict[str, list] = {c: [] for c in idx}
+        n_filas = 0
+        for row in rows:
+            if not any(v is not None for v in row):
+                continue
+            n = len(row)
+            vals = tuple(row[i] if i < n else None for i in idx.values())
+            huella.update(repr(vals).encode())
+            n_filas += 1
+            if n_filas > desde:
+                for c, v in zip(idx, vals):
+                    valores[c].append(v)
+            elif n_filas == desde:
+                digest_prefijo = huella.hexdigest()
+    finally:
+        wb.close()
+
+    data = {}
+    for c in [c for c in columns if c in idx]:
+        col = pd.Series(valores[c], dtype=object)
+        if c in _HIST_FECHAS:
+            data[c] = pd.to_datetime(col, errors="coerce")
+        elif c in _HIST_NUMEROS:
+            data[c] = pd.to_numeric(col, errors="coerce")
+        else:
+            data[c] = pd.Series(valores[c])  # inferencia normal (igual que read_excel)
+    info = {"n_filas": n_filas, "digest": huella.hexdigest(), "digest_prefijo": digest_prefijo}
+    return pd.DataFrame(data), info
+
+
+def _normalizar_hoja(sheet_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Tipos y casos especiales de las hojas del histórico."""
     # 👇 Caso especial para la hoja COP
     if sheet_name == "1444 - Maria Moises COP":
         if 'Fecha de Carga' not in df.columns and 'Fecha' in df.columns:
@@ -86,14 +656,69 @@ def load_data(sheet_name: str) -> pd.DataFrame:
     return df
 
 
+# ============== Tipos compactos para el histórico cacheado ==============
+# Columnas de pocos valores distintos -> category; texto libre -> string de Arrow.
+# 'Monto' sigue en float64: un int64 en centavos ocupa lo mismo (8 bytes) y obligaría a
+# convertir en cada vista; el ahorro real está en las columnas de texto.
+HIST_CATEGORICAS = ["Tipo", "Motivo"]
+HIST_TEXTO = ["Nombre del producto", "Descripcion"]
+
+
+def _compactar_historico(sheet_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Pasa el histórico a tipos compactos y registra cuánta memoria se ahorró en esa hoja."""
+    antes = int(df.memory_usage(deep=True).sum())
+    for c in HIST_CATEGORICAS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    if _HAS_ARROW:
+        for c in HIST_TEXTO:
+            if c in df.columns and df[c].dtype == object:
+                df[c] = df[c].map(lambda v: v if pd.isna(v) else str(v)).astype("string[pyarrow]")
+    despues = int(df.memory_usage(deep=True).sum())
+
+    store = _dropbox_store()
+    with store["lock"]:
+        store["memoria"][sheet_name] = {"filas": len(df), "antes": antes, "despues": despues}
+    print(f"[memoria {sheet_name}] {antes / 1e6:.2f} MB -> {despues / 1e6:.2f} MB ({len(df)} filas)")
+    return df
+
+
+def _reporte_memoria() -> pd.DataFrame:
+    """Ahorro de memoria por hoja del histórico (última carga de cada una)."""
+    store = _dropbox_store()
+    with store["lock"]:
+        filas = [{"Hoja": k, **v} for k, v in store["memoria"].items()]
+    if not filas:
+        return pd.DataFrame(columns=["Hoja", "Filas", "MB antes", "MB ahora", "Ahorro %"])
+    rep = pd.DataFrame(filas)
+    return pd.DataFrame({
+        "Hoja": rep["Hoja"],
+        "Filas": rep["filas"],
+        "MB antes": (rep["antes"] / 1e6).round(2),
+        "MB ahora": (rep["despues"] / 1e6).round(2),
+        "Ahorro %": (100 * (1 - rep["despues"] / rep["antes"].where(rep["antes"] > 0))).round(1),
+    })
+
+
 
 
 
 # === Helpers IngresosConID ===
-def _try_download_excel(path: str) -> pd.DataFrame | None:
+@_memo_compartido
+def _read_excel_version(path: str, version: str) -> pd.DataFrame:
+    """Parsea la primera hoja de un xlsx de Dropbox en una versión concreta (cacheado por versión)."""
+    hit = _dropbox_bytes(path, version)
+    if hit is None:
+        raise FileNotFoundError(f"{path} ya no está en Dropbox en la versión {version}")
+    return pd.read_excel(io.BytesIO(hit[1]))
+
+
+def _try_download_excel(path: str, fresh: bool = False) -> pd.DataFrame | None:
     try:
-        _, res = dbx.files_download(path)
-        return pd.read_excel(io.BytesIO(res.content))
+        md = _dropbox_meta(path, fresh=fresh)
+        if md is None:
+            return None
+        return _read_excel_version(path, md.content_hash or md.rev)
     except Exception:
         return None
     
@@ -136,7 +761,36 @@ def _format_dd_mm_yyyy_for_bancos(df: pd.DataFrame) -> pd.DataFrame:
     df["Fecha de Sistema"] = out
     return df
 
-@st.cache_data
+INGRESOS_MAX_WORKERS = 4  # descargas simultáneas por casillero
+
+
+@_memo_compartido
+def _load_ingreso_file(path: str, version: str) -> pd.DataFrame | None:
+    """Lee y normaliza UN archivo de ingresos/clientes en una versión concreta (con snapshot local)."""
+    df = _snapshot_read(path, "", version)
+    if df is not None:
+        return df if not df.empty else None
+
+    # Ni los bytes ni el DF crudo se guardan en el caché: del archivo solo queda el DF normalizado
+    hit = _dropbox_bytes(path, version, cachear=False)
+    if hit is None:
+        raise FileNotFoundError(f"{path} ya no está en Dropbox en la versión {version}")
+    df = pd.read_excel(io.BytesIO(hit[1]))
+    if df.empty:
+        return None
+
+    # Normaliza columnas clave para TODOS los ingresos/clientes
+    for col in ("ID_INGRESO", "Factura", "Id_cliente"):
+        if col not in df.columns:
+            df[col] = pd.NA
+
+    # Solo a INGRESOS (no Clientes) les aplicamos el formateo de fecha
+    name = path.split("/")[-1].lower()
+    if name.startswith("ingresos_") and ("davivienda" not in name):
+        df = _format_dd_mm_yyyy_for_bancos(df)
+    return _snapshot_write(path, "", version, df)
+
+
 def load_ingresos_con_id(casillero: str) -> dict[str, pd.DataFrame]:
     """
     Carga desde Dropbox SOLO los archivos de Ingresos y Clientes
@@ -147,16 +801,19 @@ def load_ingresos_con_id(casillero: str) -> dict[str, pd.DataFrame]:
         ingresos_1633_bancolombia.xlsx
         ingresos_1633_Davivienda.xlsx
         Clientes_1633.xlsx
+    El listado de la carpeta ya trae la versión (content_hash) de cada archivo:
+    solo se descargan de nuevo los que cambiaron.
     """
+    import dropbox
     base_folder = get_base_folder()
     out: dict[str, pd.DataFrame] = {}
 
     # 1) Listar archivos en la carpeta del histórico
     try:
-        res = dbx.files_list_folder(base_folder)
+        res = get_dbx().files_list_folder(base_folder)
         entries = res.entries
         while res.has_more:
-            res = dbx.files_list_folder_continue(res.cursor)
+            res = get_dbx().files_list_folder_continue(res.cursor)
             entries.extend(res.entries)
     except Exception as e:
         st.error(f"❌ No se pudieron listar archivos de Dropbox: {e}")
@@ -166,6 +823,7 @@ def load_ingresos_con_id(casillero: str) -> dict[str, pd.DataFrame]:
     patron_ing = _re.compile(rf"^ingresos_{casillero}(?:_.*)?\.xlsx$", _re.IGNORECASE)
     patron_cli = _re.compile(rf"^clientes_{casillero}\.xlsx$", _re.IGNORECASE)
 
+    pendientes: list[tuple[str, str, str]] = []  # (name, fullpath, version) a leer
     for ent in entries:
         # Solo archivos, no carpetas
         if not isinstance(ent, dropbox.files.FileMetadata):
@@ -173,27 +831,43 @@ def load_ingresos_con_id(casillero: str) -> dict[str, pd.DataFrame]:
 
         name = ent.name  # p.ej. 'ingresos_1633_bancolombia.xlsx'
         fullpath = f"{base_folder}/{name}"
+        _remember_meta(fullpath, ent)
 
         # ¿Es un archivo de ingresos o de clientes del casillero?
         if not (patron_ing.match(name) or patron_cli.match(name)):
             continue
 
-        df = _try_download_excel(fullpath)
-        if df is None or df.empty:
-            continue
-
-        # Normaliza columnas clave para TODOS los ingresos/clientes
-        for col in ("ID_INGRESO", "Factura", "Id_cliente"):
-            if col not in df.columns:
-                df[col] = pd.NA
-
-        # Solo a INGRESOS (no Clientes) les aplicamos el formateo de fecha
-        if patron_ing.match(name) and ("davivienda" not in name.lower()):
-            df = _format_dd_mm_yyyy_for_bancos(df)
-
         # Evitar duplicados por nombre
-        if name not in out:
-            out[name] = df
+        if all(name != n for n, _, _ in pendientes):
+            pendientes.append((name, fullpath, ent.content_hash or ent.rev))
+
+    # 2) Descargar + parsear en paralelo: el casillero tarda lo que su archivo más lento.
+    #    Un archivo que falla no tumba a los demás.
+    def _leer(name: str, fullpath: str, version: str):
+        t = time.perf_counter()
+        df = _load_ingreso_file(fullpath, version)
+        return df, time.perf_counter() - t
+
+    t0 = time.perf_counter()
+    leidos: dict[str, pd.DataFrame] = {}
+    with ThreadPoolExecutor(max_workers=INGRESOS_MAX_WORKERS) as pool:
+        futuros = {pool.submit(_leer, *p): p[0] for p in pendientes}
+        for fut in as_completed(futuros):
+            name = futuros[fut]
+            try:
+                df, dt = fut.result()
+            except Exception as e:
+                print(f"⚠️ [ingresos {casillero}] {name}: error al leer ({e})")
+                continue
+            print(f"[ingresos {casillero}] {name}: {dt:.2f}s")
+            if df is not None:
+                leidos[name] = df
+    print(f"[ingresos {casillero}] {len(leidos)}/{len(pendientes)} archivos en {time.perf_counter() - t0:.2f}s")
+
+    # Mismo orden que el listado de Dropbox
+    for name, _, _ in pendientes:
+        if name in leidos:
+            out[name] = leidos[name]
 
     return out
 
@@ -233,7 +907,7 @@ CONSIG_COLS = [
     "Fecha",             # fecha de la consignación (la define el admin)
     "Numero de cuenta",
     "Tipo",              # Nomina / Proveedor (clasificación; siempre entra como Ingreso_extra)
-    "Estado",            # pendiente / parcial / en revision / aprobada / rechazada
+    "Estado",            # pendiente / parcial / procesando / en revision / aprobada / rechazada
     "Fecha creacion",    # cuándo la creó el admin
     "Fecha realizado",   # primera vez que Mayra adjuntó comprobante
     "Fecha decision",    # cuándo se aprobó/rechazó
@@ -247,19 +921,165 @@ CONSIG_COLS = [
     "Egreso retiro",     # monto + comisión -> egreso que se carga a A
 ]
 CONSIG_TIPOS = ["Nomina", "Proveedor"]
-CONSIG_ESTADOS = ["pendiente", "parcial", "en revision", "aprobada", "rechazada"]
+CONSIG_ESTADOS = ["pendiente", "parcial", "procesando", "en revision", "aprobada", "rechazada"]
+
+
+# Cambios de estado por fila (comprobante, aprobación, rechazo) NO reescriben el xlsx: cada
+# escritura sube UN objeto pequeño y nuevo a la carpeta consignaciones_cambios/
+# (<cas>__<timestamp>-<aleatorio>.jsonl, una operación JSON por línea, upsert idempotente por
+# ID). Un solo listado de esa carpeta dice qué operaciones tiene pendientes cada casillero.
+# La vista = xlsx base + operaciones reproducidas en orden. Cuando un casillero junta
+# CONSIG_LOG_COMPACTAR objetos (o en cualquier guardado completo) se reescribe el xlsx y se
+# borran exactamente los objetos que ya quedaron en él.
+CONSIG_LOG_COMPACTAR = 25
 
 
 def _consignaciones_path(casillero: str) -> str:
     return f"{get_base_folder()}/consignaciones_{casillero}.xlsx"
 
 
-@st.cache_data
+def _consignaciones_log_folder() -> str:
+    return f"{get_base_folder()}/consignaciones_cambios"
+
+
+def _listado_log(fresh: bool = False) -> dict[str, tuple]:
+    """casillero -> nombres (ordenados) de sus operaciones sin compactar. Se memoriza igual
+    que la metadata (_META_TTL_S)."""
+    store = _dropbox_store()
+    with store["lock"]:
+        hit = store["log"]
+    if hit is not None and not fresh and time.monotonic() - hit[0] < _META_TTL_S:
+        return hit[1]
+    import dropbox
+    try:
+        res = get_dbx().files_list_folder(_consignaciones_log_folder())
+        entries = list(res.entries)
+        while res.has_more:
+            res = get_dbx().files_list_folder_continue(res.cursor)
+            entries.extend(res.entries)
+    except dropbox.exceptions.ApiError as e:
+        if not _es_no_encontrado(e):
+            raise
+        entries = []  # aún no se ha registrado ningún cambio
+    por_cas: dict[str, list] = {}
+    for ent in entries:
+        if isinstance(ent, dropbox.files.FileMetadata) and "__" in ent.name:
+            por_cas.setdefault(ent.name.split("__", 1)[0], []).append(ent.name)
+    listado = {cas: tuple(sorted(nombres)) for cas, nombres in por_cas.items()}
+    with store["lock"]:
+        store["log"] = (time.monotonic(), listado)
+    return listado
+
+
+def _registrar_log(casillero: str, agregar=(), quitar=()) -> tuple:
+    """Aplica al listado memorizado lo que esta sesión acaba de subir/borrar (sin volver a listar)."""
+    store = _dropbox_store()
+    with store["lock"]:
+        hit = store["log"]
+        if hit is not None:
+            nombres = tuple(sorted((set(hit[1].get(casillero, ())) | set(agregar)) - set(quitar)))
+            listado = {**hit[1], casillero: nombres}
+            if not nombres:
+                listado.pop(casillero)
+            store["log"] = (hit[0], listado)
+            return nombres
+    return _listado_log(fresh=True).get(casillero, ())
+
+
+def _consignaciones_version(casillero: str, fresh: bool = False) -> tuple[str | None, tuple | None]:
+    """(versión del xlsx, operaciones del log sin compactar); None = no hay."""
+    try:
+        if fresh:
+            _dropbox_meta(_consignaciones_path(casillero), fresh=True)
+        return _dropbox_version(_consignaciones_path(casillero)), _listado_log(fresh=fresh).get(casillero)
+    except Exception:
+        return None, None
+
+
 def load_consignaciones(casillero: str) -> pd.DataFrame:
-    """Carga consignaciones_<casillero>.xlsx desde Dropbox. Si no existe aún, DF vacío con columnas."""
+    """Carga consignaciones_<casillero>.xlsx (+ su log de cambios) desde Dropbox. Si no existe
+    aún, DF vacío con columnas."""
+    return _consignaciones_y_version(casillero)[0]
+
+
+def _consignaciones_y_version(casillero: str) -> tuple[pd.DataFrame, tuple]:
+    """Como load_consignaciones, más la versión de la que salió (para guardarlo sin pisar a nadie)."""
+    version = _consignaciones_version(casillero)
+    try:
+        return _load_consignaciones_version(casillero, *version), version
+    except FileNotFoundError:
+        # El listado memorizado quedó viejo (otra sesión compactó): se relee una vez sin memoria
+        version = _consignaciones_version(casillero, fresh=True)
+        return _load_consignaciones_version(casillero, *version), version
+
+
+@_memo_compartido
+def _load_consignaciones_version(casillero: str, version: str | None, version_log: tuple | None) -> pd.DataFrame:
+    """Vista de consignaciones en una versión concreta del xlsx y del log. Si alguna operación
+    no se puede leer, lanza la excepción: nunca se cachea (ni se guarda) una vista incompleta."""
+    df = _load_consignaciones_base(_consignaciones_path(casillero), version)
+    if not version_log:
+        return df
+    return _aplicar_cambios(df, _leer_operaciones(version_log))
+
+
+def _leer_operaciones(nombres: tuple) -> bytes:
+    """Contenido de esos objetos del log, en orden. Nunca cambian: cada uno se descarga una vez."""
+    import dropbox
+    folder = _consignaciones_log_folder()
+    cache = _cache_compartido()
+
+    def _descargar(path: str) -> bytes:
+        try:
+            return get_dbx().files_download(path)[1].content
+        except dropbox.exceptions.ApiError as e:
+            if not _es_no_encontrado(e):
+                raise
+            # Ya se compactó: esta versión del log quedó vieja (no se cachea nada)
+            raise FileNotFoundError(f"{path} ya no está en el log de consignaciones") from e
+
+    def _leer(nombre: str) -> bytes:
+        path = f"{folder}/{nombre}"
+        return cache.get_or_load(("op", path.lower()), lambda: _descargar(path))
+
+    faltan = [n for n in nombres if cache.peek(("op", f"{folder}/{n}".lower())) is None]
+    if len(faltan) > 1:
+        with ThreadPoolExecutor(max_workers=INGRESOS_MAX_WORKERS) as pool:
+            list(pool.map(_leer, faltan))
+    return b"".join(_leer(n) for n in nombres)
+
+
+def _aplicar_cambios(df: pd.DataFrame, content: bytes) -> pd.DataFrame:
+    """Reproduce el log (una operación JSON por línea) sobre una copia del DF base."""
+    df = df.copy()
+    ids = df["ID"].astype(str)
+    for linea in content.decode("utf-8").splitlines():
+        try:
+            op = json.loads(linea)
+        except Exception:
+            continue  # línea a medio escribir: se ignora
+        mask = ids == str(op.get("ID"))
+        if not mask.any():
+            continue
+        for k, v in (op.get("set") or {}).items():
+            if k not in df.columns:
+                df[k] = pd.NA
+            if isinstance(v, str) and df[k].dtype != object:
+                df[k] = df[k].astype(object)  # p.ej. fechas en una columna que Excel leyó vacía (float)
+            df.loc[mask, k] = v
+    return df
+
+
+@_memo_compartido
+def _load_consignaciones_base(path: str, version: str | None) -> pd.DataFrame:
+    """Parsea el archivo de consignaciones en una versión concreta (None = aún no existe)."""
+    hit = None if version is None else _dropbox_bytes(path, version)
+    if version is not None and hit is None:
+        # No se cachea un DF vacío bajo una versión que sí existía: un guardado posterior
+        # reescribiría el archivo sin sus filas.
+        raise FileNotFoundError(f"{path} ya no está en Dropbox en la versión {version}")
     try:
-        _, res = dbx.files_download(_consignaciones_path(casillero))
-        df = pd.read_excel(io.BytesIO(res.content), sheet_name=CONSIG_SHEET)
+        df = pd.DataFrame(columns=CONSIG_COLS) if hit is None else pd.read_excel(io.BytesIO(hit[1]), sheet_name=CONSIG_SHEET)
     except Exception:
         df = pd.DataFrame(columns=CONSIG_COLS)
     # Garantizar todas las columnas esperadas (por si el archivo es viejo)
@@ -269,24 +1089,49 @@ def load_consignaciones(casillero: str) -> pd.DataFrame:
     return df[CONSIG_COLS]
 
 
-def _save_consignaciones_to_dropbox(df_to_save: pd.DataFrame, casillero: str) -> bool:
-    """Guarda el DF de consignaciones en Dropbox (mismo patrón que _save_clientes_to_dropbox)."""
+def _save_consignaciones_to_dropbox(df_to_save: pd.DataFrame, casillero: str, version: tuple) -> bool:
+    """Guarda el DF de consignaciones en Dropbox (mismo patrón que _save_clientes_to_dropbox).
+    `version` es la de _consignaciones_y_version de la que salió el DF."""
     try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as w:
-            cols = [c for c in CONSIG_COLS if c in df_to_save.columns]
-            rest = [c for c in df_to_save.columns if c not in cols]
-            df_to_save[cols + rest].to_excel(w, index=False, sheet_name=CONSIG_SHEET)
-        buf.seek(0)
-        dbx.files_upload(
-            buf.read(), _consignaciones_path(casillero), mode=dropbox.files.WriteMode.overwrite
-        )
+        _escribir_consignaciones(df_to_save, casillero, version)
         return True
     except Exception as e:
+        if _es_conflicto(e):
+            e = "otra sesión las modificó mientras tanto; recarga e inténtalo de nuevo"
         st.error(f"❌ No se pudo guardar el archivo de consignaciones: {e}")
         return False
 
 
+def _escribir_consignaciones(df_to_save: pd.DataFrame, casillero: str, version: tuple) -> None:
+    """
+    Reescribe consignaciones_<casillero>.xlsx con WriteMode.update sobre la revisión de la que
+    salió el DF (si otra sesión lo reescribió en medio, Dropbox responde conflicto y no se pisa
+    nada) y borra del log solo las operaciones que ese DF ya traía.
+    """
+    import dropbox
+    path = _consignaciones_path(casillero)
+    version_xlsx, version_log = version
+    buf = io.BytesIO()
+    with pd.ExcelWriter(buf, engine="openpyxl") as w:
+        cols = [c for c in CONSIG_COLS if c in df_to_save.columns]
+        rest = [c for c in df_to_save.columns if c not in cols]
+        df_to_save[cols + rest].to_excel(w, index=False, sheet_name=CONSIG_SHEET)
+    data = buf.getvalue()
+    md = _dropbox_meta(path, fresh=True)
+    if (None if md is None else (md.content_hash or md.rev)) != version_xlsx:
+        raise RuntimeError("otra sesión las modificó mientras tanto; recarga e inténtalo de nuevo")
+    mode = dropbox.files.WriteMode.add if md is None else dropbox.files.WriteMode.update(md.rev)
+    md = get_dbx().files_upload(data, path, mode=mode)
+    _remember_meta(path, md)
+    nueva = md.content_hash or md.rev
+    _cache_compartido().put(("raw", path.lower()), (nueva, data))
+    restantes = _vaciar_log_consignaciones(casillero, version_log)
+    _actualizar_indice(
+        casillero, (nueva, restantes or None),
+        df_to_save if not restantes else _load_consignaciones_version(casillero, nueva, restantes),
+    )
+
+
 def _next_consignacion_id(df: pd.DataFrame) -> str:
     """Siguiente consecutivo 'ConsignacionN' a partir del máximo existente."""
     if df.empty or "ID" not in df.columns:
@@ -301,91 +1146,366 @@ def _next_consignacion_id(df: pd.DataFrame) -> str:
     return f"Consignacion{int(nums.astype(int).max()) + 1}"
 
 
-def _all_retiros() -> pd.DataFrame:
-    """Junta los retiros (consignaciones con 'Mayorista retira') de TODOS los casilleros."""
-    frames = []
+# ============== Índice de consignaciones (todos los casilleros) ==============
+# Los retiros viven repartidos en los consignaciones_<B>.xlsx de quien los cobra. En vez de
+# abrir los 11 archivos en cada consulta, el proceso mantiene un índice por casillero B
+# (validado por versión con UN listado de la carpeta) y lo reagrupa por quien retira (A):
+# listar los retiros de A y el siguiente 'retiroN' son búsquedas directas. El mismo índice
+# guarda la huella de cada comprobante ya usado (en cualquier casillero) para detectar
+# duplicados sin releer los JSON; las de los casilleros de PRUEBA van aparte, para que un
+# comprobante de prueba nunca bloquee uno real (ni al revés). Cada guardado de
+# consignaciones actualiza su parte del índice sin volver a descargar nada.
+@st.cache_resource(show_spinner=False)
+def _indice_store() -> dict:
+    return {"lock": threading.Lock(), "partes": {}, "por_a": {}, "max": {}, "huellas": {}, "huellas_prueba": {}}
+
+
+def _es_casillero_prueba(casillero: str) -> bool:
+    return str(casillero).startswith("PRUEBA-")
+
+
+def _huella_comprobante(cuenta, referencia, monto, fecha) -> str | None:
+    """Huella de cuenta + referencia + monto + fecha normalizados (None si no hay ref/monto)."""
+    cta, ref, fch, mto = _norm_cta(cuenta), _norm_txt(referencia), _norm_txt(fecha), _norm_monto(monto)
+    if not ref or mto is None:
+        return None
+    return hashlib.blake2b(f"{cta}|{ref}|{mto:.2f}|{fch}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _huellas_de(casillero: str, tabla: pd.DataFrame) -> dict:
+    """huella -> (casillero, ID) de todos los comprobantes de un archivo de consignaciones."""
+    out = {}
+    for h, cid in zip(tabla["huella"], tabla["ID"]):
+        if h is not None:
+            out.setdefault(h, (casillero, cid))
+    return out
+
+
+def _norm_casillero(x) -> str:
+    """'1444', 1444 y 1444.0 (como vuelve de Excel) son el mismo casillero."""
+    if x is None or (isinstance(x, float) and math.isnan(x)) or x is pd.NA:
+        return ""
+    s = str(x).strip()
+    return "" if s in ("nan", "None", "<NA>") else re.sub(r"\.0+$", "", s)
+
+
+def _actualizar_indice(casillero: str, version: tuple, df: pd.DataFrame, comprobantes: dict | None = None) -> None:
+    """Reemplaza la parte del índice que sale de consignaciones_<casillero> (en esa versión).
+    Solo se rearman los grupos de los mayoristas (A) que aparecen en esa parte."""
+    if comprobantes is None:
+        comprobantes = _parsear_comprobantes(df)
+    grupos, maximos = {}, {}  # A -> retiros de A cobrados por este casillero / mayor 'retiroN'
+    if df is not None and "Mayorista retira" in df.columns:
+        retira = df["Mayorista retira"].map(_norm_casillero)
+        parte = df[retira.ne("")].assign(**{"Mayorista retira": retira[retira.ne("")], "_recibe": casillero})
+        if not parte.empty:
+            nums = pd.to_numeric(
+                parte["ID retiro"].astype(str).str.extract(r"(\d+)\s*$", expand=False), errors="coerce"
+            )
+            for a, idx in parte.groupby("Mayorista retira").groups.items():
+                grupos[a] = parte.loc[idx].reset_index(drop=True)
+                m = nums.loc[idx].max()
+                maximos[a] = 0 if pd.isna(m) else int(m)
+    huellas = _huellas_de(casillero, comprobantes["tabla"])
+    store = _indice_store()
+    with store["lock"]:
+        previa = store["partes"].get(casillero)
+        store["partes"][casillero] = (version, grupos, maximos, huellas)
+        tipo = "huellas_prueba" if _es_casillero_prueba(casillero) else "huellas"
+        todas = {}
+        for cas, (*_, h) in store["partes"].items():
+            if _es_casillero_prueba(cas) == (tipo == "huellas_prueba"):
+                todas.update(h)
+        store[tipo] = todas
+        for a in set(grupos) | (set(previa[1]) if previa else set()):
+            trozos = [p[1][a] for p in store["partes"].values() if a in p[1]]
+            if trozos:
+                store["por_a"][a] = pd.concat(trozos, ignore_index=True)
+                store["max"][a] = max(p[2][a] for p in store["partes"].values() if a in p[2])
+            else:
+                store["por_a"].pop(a, None)
+                store["max"].pop(a, None)
+
+
+def _indice_consignaciones() -> dict:
+    """Índice vigente: solo re-indexa los casilleros cuyo archivo cambió de versión."""
+    try:
+        _metadata_por_listado([_consignaciones_path(cas) for cas in CASILLEROS])
+    except Exception:
+        pass  # cae al get_metadata por archivo
+    store = _indice_store()
     for cas in CASILLEROS:
-        df = load_consignaciones(cas)
-        if "Mayorista retira" not in df.columns:
-            continue
-        col = df["Mayorista retira"].astype(str).str.strip()
-        r = df[~col.isin(["", "nan", "None"]) & df["Mayorista retira"].notna()].copy()
-        if not r.empty:
-            r["_recibe"] = cas
-            frames.append(r)
-    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        version = _consignaciones_version(cas)
+        with store["lock"]:
+            parte = store["partes"].get(cas)
+        if parte is None or parte[0] != version:
+            _actualizar_indice(
+                cas, version, _load_consignaciones_version(cas, *version), _comprobantes_version(cas, *version)
+            )
+    return store
 
 
 def _next_retiro_id(casillero_retira: str) -> str:
     """Consecutivo 'retiroN' por mayorista que retira (A)."""
-    allr = _all_retiros()
-    if allr.empty:
-        return "retiro1"
-    mine = allr[allr["Mayorista retira"].astype(str).str.strip() == str(casillero_retira)]
-    nums = mine["ID retiro"].astype(str).str.extract(r"(\d+)\s*$", expand=False).dropna()
-    return f"retiro{int(nums.astype(int).max()) + 1}" if not nums.empty else "retiro1"
+    return f"retiro{_indice_consignaciones()['max'].get(_norm_casillero(casillero_retira), 0) + 1}"
 
 
 def _retiros_de(casillero_retira: str) -> pd.DataFrame:
     """Retiros donde este mayorista es el que RETIRA (A)."""
-    allr = _all_retiros()
-    if allr.empty:
-        return allr
-    return allr[allr["Mayorista retira"].astype(str).str.strip() == str(casillero_retira)].copy()
-
-
-def _pendientes_saldo(casillero: str, df_hist: pd.DataFrame):
+    df = _indice_consignaciones()["por_a"].get(_norm_casillero(casillero_retira))
+    return pd.DataFrame() if df is None else df.copy()
+
+
+@_memo_compartido
+def _ordenes_historico(path: str, version: str, sheet: str) -> pd.Index:
+    """'Orden' ya normalizada del histórico (una vez por versión): índice para el anti-join."""
+    df = _load_sheet(path, version, sheet)
+    if "Orden" not in df.columns:
+        return pd.Index([], dtype=object)
+    idx = pd.Index(df["Orden"].dropna().astype(str).str.strip().unique())
+    idx.get_indexer([""])  # arma la tabla hash del índice una sola vez (queda cacheada con él)
+    return idx
+
+
+def _pendientes_de(df: pd.DataFrame, col_id: str, col_monto: str, tipo: str, ordenes: pd.Index) -> pd.DataFrame:
+    """Filas APROBADAS cuyo ID aún no aparece como 'Orden' en el histórico."""
+    ids = df[col_id].astype(str).str.strip()
+    aprobada = df["Estado"].astype(str).str.strip().str.lower().eq("aprobada").to_numpy()
+    pendiente = aprobada & (ordenes.get_indexer(ids) < 0)
+    monto = pd.to_numeric(df[col_monto], errors="coerce").round(2).fillna(0.0).to_numpy()
+    return pd.DataFrame({
+        "Tipo": tipo,
+        "ID": ids.to_numpy()[pendiente],
+        "Descripcion": df["Descripcion"].to_numpy()[pendiente] if "Descripcion" in df.columns else "",
+        "Monto": monto[pendiente],
+    })
+
+
+def _pendientes_saldo(casillero: str, sheet: str):
     """Saldo en vivo: suma de consignaciones/retiros APROBADOS que AÚN no están en el
-    histórico (detectados por 'Orden'). Devuelve (ingresos_pendientes, egresos_pendientes).
-    Cuando el generador ya los cargó (Orden presente en el histórico), dejan de contar
-    -> no se duplican."""
-    ordenes = set()
-    if df_hist is not None and "Orden" in df_hist.columns:
-        ordenes = set(df_hist["Orden"].astype(str).str.strip())
-    ing = 0.0
-    egr = 0.0
+    histórico (detectados por 'Orden'). Devuelve (ingresos_pendientes, egresos_pendientes,
+    detalle por ítem). Cuando el generador ya los cargó (Orden presente en el histórico),
+    dejan de contar -> no se duplican."""
+    t = time.perf_counter()
+    path = cfg_dbx["remote_path"]
+    version = _dropbox_version(path)
+    ordenes = _ordenes_historico(path, version, sheet) if version else pd.Index([], dtype=object)
+    partes = []
     dcons = load_consignaciones(casillero)
     if dcons is not None and not dcons.empty:
-        ap = dcons[dcons["Estado"].astype(str).str.strip().str.lower() == "aprobada"]
-        for _, r in ap.iterrows():
-            if str(r.get("ID", "")).strip() not in ordenes:
-                ing += _norm_monto(r.get("Monto")) or 0
+        partes.append(_pendientes_de(dcons, "ID", "Monto", "Consignación", ordenes))
     dret = _retiros_de(casillero)
     if dret is not None and not dret.empty:
-        apr = dret[dret["Estado"].astype(str).str.strip().str.lower() == "aprobada"]
-        for _, r in apr.iterrows():
-            if str(r.get("ID retiro", "")).strip() not in ordenes:
-                egr += _norm_monto(r.get("Egreso retiro")) or 0
-    return ing, egr
+        partes.append(_pendientes_de(dret, "ID retiro", "Egreso retiro", "Retiro", ordenes))
+    detalle = (
+        pd.concat(partes, ignore_index=True) if partes
+        else pd.DataFrame(columns=["Tipo", "ID", "Descripcion", "Monto"])
+    )
+    montos = detalle["Monto"].to_numpy(dtype=float)
+    es_ing = (detalle["Tipo"] == "Consignación").to_numpy()
+    ing = float(np.sum(montos[es_ing]))
+    egr = float(np.sum(montos[~es_ing]))
+    _registrar_metrica("saldo en vivo (ms)", (time.perf_counter() - t) * 1000)
+    return ing, egr, detalle
+
+
+def _es_conflicto(e: Exception) -> bool:
+    """True si el ApiError de Dropbox es un conflicto de escritura (el archivo cambió)."""
+    err = getattr(e, "error", None)
+    try:
+        return err.is_path() and err.get_path().reason.is_conflict()
+    except Exception:
+        return False
+
+
+def _append_cambio_consignacion(casillero: str, op: dict | list) -> int:
+    """
+    Agrega una operación (o varias, en una sola subida) al log del casillero como un objeto
+    NUEVO con WriteMode.add: se sube solo ese objeto (unos cientos de bytes), sin releer el log
+    ni reintentar por conflictos. Devuelve cuántos objetos tiene el log del casillero.
+    """
+    import dropbox
+    import uuid
+    ops = op if isinstance(op, list) else [op]
+    data = b"".join(
+        (json.dumps(o, ensure_ascii=False, default=lambda x: x.item() if hasattr(x, "item") else str(x)) + "\n").encode("utf-8")
+        for o in ops
+    )
+    nombre = f"{casillero}__{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.jsonl"
+    path = f"{_consignaciones_log_folder()}/{nombre}"
+    get_dbx().files_upload(data, path, mode=dropbox.files.WriteMode.add)
+    _cache_compartido().put(("op", path.lower()), data)
+    return len(_registrar_log(casillero, agregar=[nombre]))
+
+
+def _vaciar_log_consignaciones(casillero: str, version_log: tuple | None) -> tuple:
+    """Borra del log SOLO las operaciones de `version_log` (las que se reprodujeron en el DF que
+    se acaba de guardar); las que otra sesión agregó después se conservan. Devuelve las que quedan."""
+    import dropbox
+    if not version_log:
+        return _listado_log().get(casillero, ())
+    folder = _consignaciones_log_folder()
+    try:
+        get_dbx().files_delete_batch([dropbox.files.DeleteArg(f"{folder}/{n}") for n in version_log])
+    except Exception as e:
+        # Quedan en el log: reproducirlas sobre el xlsx nuevo da lo mismo (ya están en él)
+        print(f"⚠️ No se pudo vaciar el log de consignaciones_{casillero}: {e}")
+        return _listado_log().get(casillero, ())
+    return _registrar_log(casillero, quitar=version_log)
 
 
 def _update_consignacion(casillero: str, consig_id: str, updates: dict) -> bool:
-    """Carga, actualiza la fila por ID, y vuelve a guardar en Dropbox."""
+    """Actualiza la fila por ID agregando el cambio al log del casillero (no reescribe el xlsx)."""
+    return _update_consignaciones_lote(casillero, {str(consig_id): updates})
+
+
+def _update_consignaciones_lote(casillero: str, cambios: dict) -> bool:
+    """Varios cambios {ID: updates} del mismo casillero en UNA sola escritura del log."""
+    try:
+        _registrar_cambios_consignacion(casillero, cambios)
+        return True
+    except LookupError as e:
+        st.error(str(e))
+    except Exception as e:
+        st.error(f"❌ No se pudo guardar el cambio de la consignación: {e}")
+    return False
+
+
+def _registrar_cambios_consignacion(casillero: str, cambios: dict) -> None:
+    """Lo mismo que _update_consignaciones_lote pero sin tocar la página: si algo falla, lanza
+    la excepción (la usan los hilos de fondo, donde st.error no llega a ninguna sesión)."""
+    if not cambios:
+        return
     df = load_consignaciones(casillero)
-    mask = df["ID"].astype(str) == str(consig_id)
-    if not mask.any():
-        st.error(f"No se encontró la consignación {consig_id}.")
-        return False
-    for k, v in updates.items():
-        df.loc[mask, k] = v
-    ok = _save_consignaciones_to_dropbox(df, casillero)
-    if ok:
-        load_consignaciones.clear()
-    return ok
+    faltan = set(map(str, cambios)) - set(df["ID"].astype(str))
+    if faltan:
+        raise LookupError(f"No se encontró la consignación {', '.join(sorted(faltan))}.")
+    ts = pd.Timestamp.now().isoformat(timespec="seconds")
+    ops = [{"ID": str(cid), "set": dict(updates), "ts": ts} for cid, updates in cambios.items()]
+    n_ops = _append_cambio_consignacion(casillero, ops)
+    if n_ops >= CONSIG_LOG_COMPACTAR:
+        try:
+            # Si el log no se reproduce completo, falla aquí y no se reescribe ni se borra nada
+            df, version = _consignaciones_y_version(casillero)
+            _escribir_consignaciones(df, casillero, version)
+            return
+        except Exception as e:
+            # El cambio ya quedó en el log; la compactación se reintenta con el próximo cambio
+            print(f"⚠️ No se pudo compactar consignaciones_{casillero}: {e}")
+    df, version = _consignaciones_y_version(casillero)
+    _actualizar_indice(casillero, version, df, _comprobantes_version(casillero, *version))
 
 
 def _comprobantes_folder(casillero: str) -> str:
     return f"{get_base_folder()}/comprobantes_{casillero}"
 
 
-def _upload_comprobante(casillero: str, consig_id: str, uploaded_file) -> str | None:
-    """Sube el pantallazo a Dropbox y devuelve la ruta guardada."""
+# --- Normalización de comprobantes (antes de subir y de leer con IA) ---
+# Los pantallazos del celular llegan a resolución completa (y a veces girados). Se enderezan
+# según el EXIF, se recortan los márgenes lisos y se reducen al tamaño máximo que el modelo
+# de visión usa de todas formas (lado mayor 1568 px, ~1.15 MP); se guardan en JPEG.
+COMPROBANTE_LADO_MAX = 1568
+COMPROBANTE_MAX_PIXELES = 1_150_000
+COMPROBANTE_CALIDAD = 85
+
+
+def _tokens_vision(ancho: int, alto: int) -> int:
+    """Tokens de entrada estimados de una imagen (el modelo la reduce a LADO_MAX / MAX_PIXELES)."""
+    if ancho <= 0 or alto <= 0:
+        return 0
+    escala = min(1.0, COMPROBANTE_LADO_MAX / max(ancho, alto), math.sqrt(COMPROBANTE_MAX_PIXELES / (ancho * alto)))
+    return int(ancho * alto * escala * escala / 750)
+
+
+def _recortar_margenes(im, tolerancia: int = 8, relleno: int = 8):
+    """Quita bordes de color liso (el de la esquina superior izquierda)."""
+    from PIL import Image, ImageChops
+    fondo = Image.new(im.mode, im.size, im.getpixel((0, 0)))
+    diff = ImageChops.difference(im, fondo).convert("L").point(lambda p: 255 if p > tolerancia else 0)
+    caja = diff.getbbox()
+    if not caja:
+        return im
+    x0, y0, x1, y1 = caja
+    caja = (max(x0 - relleno, 0), max(y0 - relleno, 0), min(x1 + relleno, im.width), min(y1 + relleno, im.height))
+    return im if caja == (0, 0, im.width, im.height) else im.crop(caja)
+
+
+def _normalizar_comprobante(data: bytes, media_type: str, nombre: str) -> dict:
+    """
+    Devuelve {data, media_type, nombre, info}. Si la imagen no se puede procesar (o el
+    resultado no es más liviano), se conserva el original tal cual.
+    """
+    t0 = time.perf_counter()
+    info = {"bytes_original": len(data), "bytes_final": len(data), "tokens_original": 0, "tokens_final": 0,
+            "dims_original": "", "dims_final": ""}
+    out = {"data": data, "media_type": media_type, "nombre": nombre, "info": info}
+    try:
+        from PIL import Image, ImageOps
+        im = Image.open(io.BytesIO(data))
+        info["dims_original"] = f"{im.width}x{im.height}"
+        info["tokens_original"] = info["tokens_final"] = _tokens_vision(im.width, im.height)
+        im = ImageOps.exif_transpose(im)
+        if im.mode in ("RGBA", "LA", "P"):
+            im = im.convert("RGBA")
+            plano = Image.new("RGB", im.size, (255, 255, 255))
+            plano.paste(im, mask=im.getchannel("A"))
+            im = plano
+        else:
+            im = im.convert("RGB")
+        im = _recortar_margenes(im)
+        # Nunca más píxeles de los que el modelo habría usado del original (no sube el costo)
+        max_px = min(COMPROBANTE_MAX_PIXELES, info["tokens_original"] * 750 or COMPROBANTE_MAX_PIXELES)
+        escala = min(1.0, COMPROBANTE_LADO_MAX / max(im.size), math.sqrt(max_px / (im.width * im.height)))
+        if escala < 1.0:
+            im = im.resize((max(int(im.width * escala), 1), max(int(im.height * escala), 1)), Image.LANCZOS)
+        buf = io.BytesIO()
+        im.save(buf, format="JPEG", quality=COMPROBANTE_CALIDAD, optimize=True)
+        if buf.tell() < len(data):
+            out.update(data=buf.getvalue(), media_type="image/jpeg", nombre=os.path.splitext(nombre)[0] + ".jpg")
+            info.update(bytes_final=buf.tell(), dims_final=f"{im.width}x{im.height}",
+                        tokens_final=_tokens_vision(im.width, im.height))
+    except Exception:
+        pass
+    info["normalizar_ms"] = (time.perf_counter() - t0) * 1000
+    return out
+
+
+def _registrar_normalizacion(info: dict, subida_s: float) -> None:
+    """Ahorro por comprobante: bytes, tokens de visión y tiempo de subida (estimado con el
+    caudal observado en esta misma subida)."""
+    orig, final = info["bytes_original"], max(info["bytes_final"], 1)
+    ahorro_subida_ms = subida_s * 1000 * (orig / final - 1)
+    fila = {
+        **info,
+        "ahorro bytes %": round(100 * (1 - final / max(orig, 1)), 1),
+        "subida_ms": round(subida_s * 1000, 1),
+        "ahorro subida estimado (ms)": round(ahorro_subida_ms, 1),
+        "ahorro neto estimado (ms)": round(ahorro_subida_ms - info["normalizar_ms"], 1),
+    }
+    fila["normalizar_ms"] = round(info["normalizar_ms"], 1)
+    store = _metricas_store()
+    with store["lock"]:
+        store["comprobantes"].append(fila)
+    _registrar_metrica("comprobante: ahorro de bytes (%)", fila["ahorro bytes %"])
+    _registrar_metrica("comprobante: normalización (ms)", fila["normalizar_ms"])
+    _registrar_metrica("comprobante: ahorro neto estimado (ms)", fila["ahorro neto estimado (ms)"])
+    _registrar_metrica("comprobante: tokens de visión ahorrados", info["tokens_original"] - info["tokens_final"])
+
+
+def _reporte_comprobantes() -> pd.DataFrame:
+    store = _metricas_store()
+    with store["lock"]:
+        return pd.DataFrame(list(store["comprobantes"]))
+
+
+def _upload_comprobante(casillero: str, consig_id: str, comp: dict) -> str | None:
+    """Sube el comprobante ya normalizado (ver _normalizar_comprobante) y devuelve la ruta guardada."""
     try:
-        nombre = re.sub(r"[^A-Za-z0-9._-]", "_", str(uploaded_file.name))
+        nombre = re.sub(r"[^A-Za-z0-9._-]", "_", str(comp["nombre"]))
         path = f"{_comprobantes_folder(casillero)}/{consig_id}_{nombre}"
-        dbx.files_upload(
-            uploaded_file.getvalue(), path, mode=dropbox.files.WriteMode.overwrite
-        )
+        t0 = time.perf_counter()
+        _dbx_upload(comp["data"], path)
+        _registrar_normalizacion(comp["info"], time.perf_counter() - t0)
         return path
     except Exception as e:
         st.error(f"❌ No se pudo subir el comprobante: {e}")
@@ -393,15 +1513,161 @@ def _upload_comprobante(casillero: str, consig_id: str, uploaded_file) -> str |
 
 
 def _download_comprobante_bytes(path: str):
-    """Descarga el comprobante para previsualizarlo. Devuelve bytes o None."""
+    """Comprobante original (validado por rev, compartido en el caché). Devuelve bytes o None."""
     try:
-        _, res = dbx.files_download(path)
-        return res.content
+        hit = _dropbox_bytes(path)
+        return None if hit is None else hit[1]
     except Exception:
         return None
 
 
+# --- Miniaturas de comprobantes (panel admin) ---
+# La previsualización usa miniaturas JPEG (las genera Dropbox; si no puede, Pillow a partir
+# del original), cacheadas por ruta + rev en memoria y en disco. El original solo se baja
+# cuando el admin pide descargarlo.
+MINIATURA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".dash_cache", "miniaturas")
+MINIATURA_LADO = 480        # px del lado mayor
+COMPROBANTES_POR_PAGINA = 8
+
+
+def _miniatura_pillow(data: bytes) -> bytes:
+    from PIL import Image
+    im = Image.open(io.BytesIO(data))
+    im.thumbnail((MINIATURA_LADO, MINIATURA_LADO))
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, format="JPEG", quality=80)
+    return buf.getvalue()
+
+
+def _generar_miniatura(path: str, rev: str) -> bytes:
+    """Miniatura de esa rev: disco -> Dropbox (files_get_thumbnail_v2) -> Pillow sobre el original.
+    Si nada funciona lanza la excepción (no se cachea el fallo: se reintenta en el próximo render)."""
+    import dropbox
+    fpath = os.path.join(
+        MINIATURA_DIR, f"{hashlib.blake2b(path.lower().encode('utf-8'), digest_size=12).hexdigest()}_{rev}.jpg"
+    )
+    try:
+        with open(fpath, "rb") as fh:
+            return fh.read()
+    except OSError:
+        pass
+    try:
+        _, res = get_dbx().files_get_thumbnail_v2(
+            dropbox.files.PathOrLink.path(f"rev:{rev}"),
+            format=dropbox.files.ThumbnailFormat.jpeg,
+            # bestfit: encaja la imagen entera en 640x480 sin recortar, así los pantallazos
+            # verticales también quedan con su lado mayor en 480 px (strict los dejaba en ~144x320)
+            size=dropbox.files.ThumbnailSize.w640h480,
+            mode=dropbox.files.ThumbnailMode.bestfit,
+        )
+        data = res.content
+    except Exception:
+        _, res = get_dbx().files_download(f"rev:{rev}")
+        data = _miniatura_pillow(res.content)
+    try:
+        os.makedirs(MINIATURA_DIR, exist_ok=True)
+        tmp = f"{fpath}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, fpath)
+    except Exception as e:
+        print(f"⚠️ No se pudo guardar la miniatura de {path}: {e}")
+    return data
+
+
+def _comprobante_miniatura(path: str) -> bytes | None:
+    """Miniatura del comprobante en su rev vigente (None si no existe / no se pudo)."""
+    if not path:
+        return None
+    try:
+        md = _dropbox_meta(path)
+    except Exception:
+        return None
+    if md is None:
+        return None
+    try:
+        return _cache_compartido().get_or_load(("miniatura", path.lower(), md.rev), lambda: _generar_miniatura(path, md.rev))
+    except Exception:
+        return None
+
+
+def _paginar(items: list, key: str, por_pagina: int = COMPROBANTES_POR_PAGINA) -> list:
+    """Muestra un selector de página (si hace falta) y devuelve solo los ítems de esa página."""
+    n_pag = max(1, math.ceil(len(items) / por_pagina))
+    if n_pag == 1:
+        return items
+    pag = st.number_input(f"Página (de {n_pag})", min_value=1, max_value=n_pag, value=1, step=1, key=key)
+    return items[(pag - 1) * por_pagina: pag * por_pagina]
+
+
+def _mostrar_comprobante(path: str, key: str, nombre: str, width: int) -> None:
+    """Miniatura + descarga del original bajo demanda (dos pasos: preparar -> descargar)."""
+    thumb = _comprobante_miniatura(path)
+    if not thumb:
+        st.caption("(No se pudo previsualizar este comprobante.)")
+        return
+    st.image(thumb, width=width)
+    fname = (path or nombre).split("/")[-1] or f"{nombre}.jpg"
+    if st.session_state.get(f"prep_{key}"):
+        img = _download_comprobante_bytes(path)
+        if img:
+            st.download_button(
+                "⬇️ Descargar",
+                data=img,
+                file_name=fname,
+                mime=("image/png" if fname.lower().endswith(".png") else "image/jpeg"),
+                key=key,
+            )
+        else:
+            st.caption("(No se pudo descargar el original.)")
+    elif st.button("📥 Preparar descarga", key=f"btn_prep_{key}"):
+        st.session_state[f"prep_{key}"] = True
+        st.rerun()
+
+
+# --- Decisiones en lote (panel admin) ---
+# La selección vive en session_state por casillero, así sobrevive al cambiar de casillero
+# en el selector; al aplicar se hace UNA escritura por casillero y UN solo rerun.
+def _lote_revision() -> dict:
+    """casillero -> lista de IDs seleccionados para decidir en lote."""
+    return st.session_state.setdefault("lote_revision", {})
+
+
+def _alternar_seleccion(casillero: str, consig_id: str) -> None:
+    sel = _lote_revision().setdefault(casillero, [])
+    if consig_id in sel:
+        sel.remove(consig_id)
+    else:
+        sel.append(consig_id)
+
+
+def _aplicar_lote_revision(estado: str) -> list:
+    """Aplica `estado` a todo lo seleccionado. Devuelve [(nivel, mensaje)] por casillero."""
+    hoy = pd.Timestamp.now().strftime("%Y-%m-%d")
+    resultados = []
+    for cas, ids in list(_lote_revision().items()):
+        if not ids:
+            continue
+        # Solo lo que sigue esperando revisión (otra sesión pudo decidirlo ya)
+        df = load_consignaciones(cas)
+        vigentes = set(df.loc[
+            df["Estado"].astype(str).str.strip().str.lower().isin(["parcial", "en revision"]), "ID"
+        ].astype(str))
+        cambios = {cid: {"Estado": estado, "Fecha decision": hoy} for cid in ids if cid in vigentes}
+        omitidas = len(ids) - len(cambios)
+        if _update_consignaciones_lote(cas, cambios):
+            msg = f"{CASILLEROS.get(cas, cas)}: {len(cambios)} {estado}(s)"
+            if omitidas:
+                msg += f" ({omitidas} ya no estaban en revisión)"
+            resultados.append(("success" if estado == "aprobada" else "warning", msg))
+            _lote_revision().pop(cas, None)
+        else:
+            resultados.append(("error", f"{CASILLEROS.get(cas, cas)}: no se pudo guardar el lote."))
+    return resultados
+
+
 # --- Lectura del comprobante con Claude (Haiku 4.5, visión) ---
+_COMPROBANTE_MODELO = "claude-haiku-4-5"
 _COMPROBANTE_PROMPT = (
     "Este es un comprobante de transferencia/consignación bancaria. "
     "Devuelve ÚNICAMENTE un objeto JSON válido (sin texto extra, sin markdown) "
@@ -431,12 +1697,13 @@ def _parse_json_laxo(texto: str):
 
 def _extraer_datos_comprobante(image_bytes: bytes, media_type: str):
     """Lee el comprobante con Claude Haiku 4.5. Devuelve (datos_dict, error_str)."""
+    anthropic_client = _anthropic_client()
     if anthropic_client is None:
         return None, "Cliente de IA no configurado (falta API key de Anthropic)."
     try:
         b64 = base64.standard_b64encode(image_bytes).decode("utf-8")
         resp = anthropic_client.messages.create(
-            model="claude-haiku-4-5",
+            model=_COMPROBANTE_MODELO,
             max_tokens=1024,
             messages=[{
                 "role": "user",
@@ -457,6 +1724,70 @@ def _extraer_datos_comprobante(image_bytes: bytes, media_type: str):
         return None, str(e)
 
 
+# --- Caché de lecturas por contenido ---
+# La misma imagen (mismos bytes) con el mismo prompt/modelo da la misma lectura: se guarda en
+# disco por SHA-256 y no se vuelve a llamar al modelo. Cada archivo registra además dónde se
+# usó la imagen, para marcar al instante un reenvío como posible duplicado.
+OCR_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".dash_cache", "ocr")
+_COMPROBANTE_PROMPT_VERSION = hashlib.sha256(
+    f"{_COMPROBANTE_MODELO}\n{_COMPROBANTE_PROMPT}".encode("utf-8")
+).hexdigest()[:12]
+
+
+def _sha_imagen(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def _ocr_cache_path(sha: str) -> str:
+    return os.path.join(OCR_CACHE_DIR, f"{sha}.json")
+
+
+def _ocr_cache_get(sha: str) -> dict:
+    """{"lecturas": {version_prompt: datos}, "usos": [{casillero, ID, ruta, ts}]} (vacío si no hay)."""
+    try:
+        with open(_ocr_cache_path(sha), encoding="utf-8") as f:
+            entrada = json.load(f)
+        if isinstance(entrada, dict):
+            return {"lecturas": entrada.get("lecturas") or {}, "usos": entrada.get("usos") or []}
+    except Exception:
+        pass
+    return {"lecturas": {}, "usos": []}
+
+
+def _ocr_cache_put(sha: str, datos: dict | None = None, uso: dict | None = None) -> None:
+    with _ocr_store()["cache_lock"]:
+        entrada = _ocr_cache_get(sha)
+        if datos is not None:
+            entrada["lecturas"][_COMPROBANTE_PROMPT_VERSION] = datos
+        if uso is not None:
+            entrada["usos"].append(uso)
+        try:
+            os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+            tmp = _ocr_cache_path(sha) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entrada, f, ensure_ascii=False)
+            os.replace(tmp, _ocr_cache_path(sha))
+        except Exception:
+            pass
+
+
+def _ocr_en_cache(sha: str) -> bool:
+    return _COMPROBANTE_PROMPT_VERSION in _ocr_cache_get(sha)["lecturas"]
+
+
+def _leer_comprobante(image_bytes: bytes, media_type: str, sha: str | None = None):
+    """_extraer_datos_comprobante con caché por contenido. Devuelve (datos, error, desde_cache).
+    Solo se guardan lecturas válidas (un error del API no se cachea)."""
+    sha = sha or _sha_imagen(image_bytes)
+    datos = _ocr_cache_get(sha)["lecturas"].get(_COMPROBANTE_PROMPT_VERSION)
+    if isinstance(datos, dict):
+        return datos, None, True
+    datos, err = _extraer_datos_comprobante(image_bytes, media_type)
+    if isinstance(datos, dict):
+        _ocr_cache_put(sha, datos=datos)
+    return datos, err, False
+
+
 def _parse_comprobantes(cell) -> list:
     """Lee la celda JSON 'Comprobantes' y devuelve la lista (o [] si vacía/ inválida)."""
     try:
@@ -474,6 +1805,45 @@ def _parse_comprobantes(cell) -> list:
         return []
 
 
+COMP_COLS = ["ID", "n", "ruta", "banco", "monto", "fecha", "cuenta", "referencia", "huella"]
+
+
+def _parsear_comprobantes(df: pd.DataFrame) -> dict:
+    """
+    Decodifica la columna JSON 'Comprobantes' de todo el archivo, una sola vez:
+      - por_id:  ID -> lista de comprobantes tal como están guardados
+      - tabla:   una fila por comprobante (ID, n, ruta, banco, monto, fecha, cuenta, referencia, huella)
+      - abonado: ID -> suma de montos de sus comprobantes
+    """
+    por_id, filas = {}, []
+    if df is not None and "Comprobantes" in df.columns:
+        for cid, cell in zip(df["ID"].astype(str), df["Comprobantes"]):
+            comps = _parse_comprobantes(cell)
+            if not comps:
+                continue
+            por_id[cid] = comps
+            for i, comp in enumerate(comps, 1):
+                filas.append({
+                    "ID": cid, "n": i,
+                    **{k: comp.get(k, "") for k in ("ruta", "banco", "fecha", "cuenta", "referencia")},
+                    "monto": _norm_monto(comp.get("monto")) or 0,
+                    "huella": _huella_comprobante(comp.get("cuenta"), comp.get("referencia"), comp.get("monto"), comp.get("fecha")),
+                })
+    tabla = pd.DataFrame(filas, columns=COMP_COLS)
+    abonado = tabla.groupby("ID")["monto"].sum().astype(float).to_dict() if not tabla.empty else {}
+    return {"por_id": por_id, "tabla": tabla, "abonado": abonado}
+
+
+@_memo_compartido
+def _comprobantes_version(casillero: str, version: str | None, version_log: tuple | None) -> dict:
+    return _parsear_comprobantes(_load_consignaciones_version(casillero, version, version_log))
+
+
+def load_comprobantes(casillero: str) -> dict:
+    """Comprobantes ya decodificados de las consignaciones del casillero (ver _parsear_comprobantes)."""
+    return _comprobantes_version(casillero, *_consignaciones_version(casillero))
+
+
 def _norm_cta(x) -> str:
     return re.sub(r"\D", "", str(x or ""))  # solo dígitos: "616-184510-29" -> "61618451029"
 
@@ -489,20 +1859,255 @@ def _norm_monto(x):
         return None
 
 
-def _es_duplicado_global(df: pd.DataFrame, cuenta, referencia, monto, fecha) -> bool:
-    """True si YA existe (en cualquier consignación) un comprobante con la MISMA
-    cuenta + referencia + monto + fecha."""
-    cta, ref, fch, mto = _norm_cta(cuenta), _norm_txt(referencia), _norm_txt(fecha), _norm_monto(monto)
-    if not ref or mto is None or "Comprobantes" not in df.columns:
+def _es_duplicado_global(cuenta, referencia, monto, fecha, casillero: str) -> bool:
+    """True si YA existe (en cualquier consignación de cualquier casillero) un comprobante con
+    la MISMA cuenta + referencia + monto + fecha. Los casilleros de PRUEBA solo se comparan
+    entre ellos."""
+    h = _huella_comprobante(cuenta, referencia, monto, fecha)
+    tipo = "huellas_prueba" if _es_casillero_prueba(casillero) else "huellas"
+    return h is not None and h in _indice_consignaciones()[tipo]
+
+
+# ============== Cola de lectura (OCR) de comprobantes ==============
+# La lectura con el modelo de visión tarda varios segundos: no se hace dentro del clic.
+# El comprobante se sube, la consignación queda "procesando" y un hilo de fondo lo lee y
+# aplica el resultado con _registrar_cambios_consignacion. La sesión consulta la cola cada OCR_POLL_S.
+OCR_MAX_WORKERS = 2
+OCR_POLL_S = 3
+OCR_RETENCION_S = 600     # trabajos terminados que nadie consultó se descartan tras 10 min
+
+
+@st.cache_resource(show_spinner=False)
+def _ocr_store() -> dict:
+    """Cola compartida por todas las sesiones del proceso."""
+    return {
+        "lock": threading.Lock(),
+        "pool": ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS, thread_name_prefix="ocr"),
+        "jobs": {},           # job_id -> {casillero, ID, estado ("en cola"/"leyendo"/"listo"), resultado, ...}
+        "casilleros": {},     # casillero -> Lock (serializa la aplicación de resultados)
+        "contadores": {"desde caché": 0, "llamadas al modelo": 0},
+        "cache_lock": threading.Lock(),   # escrituras de OCR_CACHE_DIR
+    }
+
+
+def _estado_cola_ocr() -> dict:
+    store = _ocr_store()
+    with store["lock"]:
+        estados = [j["estado"] for j in store["jobs"].values()]
+        contadores = dict(store["contadores"])
+    return {
+        "en cola": estados.count("en cola"),
+        "leyendo": estados.count("leyendo"),
+        "listos sin consultar": estados.count("listo"),
+        "hilos": OCR_MAX_WORKERS,
+        **contadores,
+    }
+
+
+def _ocr_activos(casillero: str) -> set:
+    """IDs del casillero con un trabajo de lectura en este proceso. Cuentan también los
+    terminados que ninguna sesión ha recogido: su resultado ya se guardó (o lo intentó)."""
+    store = _ocr_store()
+    with store["lock"]:
+        return {j["ID"] for j in store["jobs"].values() if j["casillero"] == casillero}
+
+
+def _aplicar_lectura_comprobante(job: dict, datos: dict | None) -> tuple[str, str]:
+    """Decide con lo leído y guarda el resultado. Devuelve (nivel, mensaje) para la sesión; si no
+    se pudo guardar, lanza la excepción (corre en un hilo de fondo, sin página donde mostrarla)."""
+    cas, cid = job["casillero"], job["ID"]
+    restaurar = {"Estado": job["estado_previo"]}
+
+    if datos is None:
+        # La IA no pudo leer -> revisión manual del admin
+        upd = {"Estado": "en revision"}
+        if job["primera"]:
+            upd["Fecha realizado"] = job["hoy"]
+        _registrar_cambios_consignacion(cas, {cid: upd})
+        return "warning", f"📎 {cid}: no se pudo procesar el comprobante automáticamente. Quedó en revisión del administrador."
+
+    cta_comp = datos.get("cuenta_destino", "")
+    cuenta_sol = job["cuenta_sol"]
+    cuenta_ok = (_norm_cta(cuenta_sol) == "" or _norm_cta(cta_comp) == _norm_cta(cuenta_sol))
+    # Mensajes genéricos al mayorista: NO se exponen las reglas internas
+    # (cuenta esperada, montos, referencias). El admin sí ve el detalle.
+    if not datos.get("es_transferencia_exitosa", True) or not cuenta_ok:
+        _registrar_cambios_consignacion(cas, {cid: restaurar})
+        return "error", f"{cid}: no se pudo registrar este comprobante. Verifica que sea correcto o contacta al administrador."
+    if _es_duplicado_global(cta_comp, datos.get("referencia"), datos.get("monto"), datos.get("fecha"), cas):
+        _registrar_cambios_consignacion(cas, {cid: restaurar})
+        return "error", f"⚠️ {cid}: este comprobante ya fue usado anteriormente. No se puede registrar de nuevo."
+
+    comp_nuevo = {
+        "ruta": job["ruta"],
+        "banco": datos.get("banco", ""),
+        "monto": _norm_monto(datos.get("monto")) or 0,
+        "fecha": datos.get("fecha", ""),
+        "cuenta": cta_comp,
+        "referencia": datos.get("referencia", ""),
+    }
+    # Se releen los comprobantes: pudo entrar otro mientras este se leía
+    comps_new = load_comprobantes(cas)["por_id"].get(cid, []) + [comp_nuevo]
+    abonado_new = sum(_norm_monto(c.get("monto")) or 0 for c in comps_new)
+    upd = {
+        "Comprobantes": json.dumps(comps_new, ensure_ascii=False),
+        "Monto abonado": abonado_new,
+    }
+    if job["primera"]:
+        upd["Fecha realizado"] = job["hoy"]
+
+    solicitado = job["solicitado"]
+    if job.get("repetida"):
+        # La misma imagen ya se había enviado (otra consignación u otro intento): lo decide el admin
+        comp_nuevo["posible_duplicado"] = job["repetida"]
+        upd["Comprobantes"] = json.dumps(comps_new, ensure_ascii=False)
+        upd["Estado"] = "en revision"
+        _registrar_cambios_consignacion(cas, {cid: upd})
+        return "warning", f"📎 {cid}: esta imagen ya se había enviado antes. Quedó en revisión del administrador."
+    if solicitado > 0 and abonado_new >= solicitado:
+        # Cubre el total -> aprobación automática (sin tocar el histórico)
+        upd["Estado"] = "aprobada"
+        upd["Fecha decision"] = job["hoy"]
+        _registrar_cambios_consignacion(cas, {cid: upd})
+        return "success", f"✅ {cid}: pago COMPLETO (${abonado_new:,.0f}). Aprobado automáticamente."
+    # Falta dinero -> pago parcial; el admin debe verlo si no completa
+    upd["Estado"] = "parcial"
+    _registrar_cambios_consignacion(cas, {cid: upd})
+    falta_new = max(solicitado - abonado_new, 0)
+    return "warning", (
+        f"💸 {cid}: abonado ${abonado_new:,.0f} de ${solicitado:,.0f}. "
+        f"Te falta ${falta_new:,.0f}. ¿Adjuntas otro comprobante para completar?"
+    )
+
+
+def _trabajo_ocr(job: dict, image_bytes: bytes, media_type: str) -> None:
+    store = _ocr_store()
+    t0 = time.monotonic()
+    job["estado"] = "leyendo"
+    _registrar_metrica("OCR espera en cola (s)", t0 - job["encolado"])
+    try:
+        datos, _err, desde_cache = _leer_comprobante(image_bytes, media_type, sha=job["sha"])
+        if desde_cache:
+            _registrar_metrica("OCR lectura desde caché (ms)", (time.monotonic() - t0) * 1000)
+        else:
+            _registrar_metrica("OCR latencia del modelo (s)", time.monotonic() - t0)
+        with store["lock"]:
+            store["contadores"]["desde caché" if desde_cache else "llamadas al modelo"] += 1
+            lock_cas = store["casilleros"].setdefault(job["casillero"], threading.Lock())
+        with lock_cas:
+            job["resultado"] = _aplicar_lectura_comprobante(job, datos)
+        _ocr_cache_put(job["sha"], uso={"casillero": job["casillero"], "ID": job["ID"], "ruta": job["ruta"],
+                                        "ts": pd.Timestamp.now().isoformat(timespec="seconds")})
+    except Exception as e:
+        # Queda en el trabajo: el hilo no tiene sesión donde mostrarlo; lo muestra _seguimiento_ocr
+        job["error"] = str(e)
+        print(f"⚠️ [OCR {job['casillero']}/{job['ID']}] {e}")
+        try:
+            _registrar_cambios_consignacion(job["casillero"], {job["ID"]: {"Estado": "en revision"}})
+        except Exception as e2:
+            # Sigue en "procesando": cuando se recoja el trabajo, _recuperar_ocr_colgados la pasa a revisión
+            job["error"] += f" (tampoco se pudo pasar a revisión: {e2})"
+    finally:
+        job["fin"] = time.monotonic()
+        _registrar_metrica("OCR total por comprobante (s)", job["fin"] - job["encolado"])
+        job["estado"] = "listo"
+
+
+def _encolar_ocr(casillero: str, row, ruta: str, image_bytes: bytes, media_type: str) -> str | None:
+    """Marca la consignación como "procesando" y deja la lectura en la cola. Devuelve el id del trabajo."""
+    store = _ocr_store()
+    cid = str(row["ID"])
+    sha = _sha_imagen(image_bytes)
+    previos = [u for u in _ocr_cache_get(sha)["usos"] if u.get("ruta") != ruta]
+    fr = row.get("Fecha realizado")
+    fr_actual = "" if pd.isna(fr) else str(fr).strip()
+    job = {
+        "id": f"{casillero}:{cid}:{time.time_ns()}",
+        "casillero": casillero,
+        "ID": cid,
+        "ruta": ruta,
+        "estado_previo": str(row["Estado"]).strip().lower(),
+        "primera": (not fr_actual or fr_actual.lower() == "nan"),
+        "hoy": pd.Timestamp.now().strftime("%Y-%m-%d"),
+        "solicitado": float(pd.to_numeric(row["Monto"], errors="coerce") or 0),
+        "cuenta_sol": str(row["Numero de cuenta"]),
+        "sha": sha,
+        "repetida": f"{previos[-1].get('casillero')}/{previos[-1].get('ID')}" if previos else None,
+        "estado": "en cola",
+        "encolado": time.monotonic(),
+        "resultado": None,
+        "error": None,
+    }
+    ahora = time.monotonic()
+    with store["lock"]:
+        # Limpieza de trabajos terminados que ninguna sesión recogió
+        for jid in [k for k, j in store["jobs"].items() if j["estado"] == "listo" and ahora - j.get("fin", ahora) > OCR_RETENCION_S]:
+            store["jobs"].pop(jid, None)
+        # Se registra ANTES de marcar "procesando" para que la recuperación no lo tome por colgado
+        store["jobs"][job["id"]] = job
+        profundidad = sum(j["estado"] != "listo" for j in store["jobs"].values())
+    _registrar_metrica("OCR trabajos en cola", profundidad)
+
+    if not _update_consignacion(casillero, cid, {"Estado": "procesando"}):
+        with store["lock"]:
+            store["jobs"].pop(job["id"], None)
+        return None
+    if _ocr_en_cache(sha):
+        _trabajo_ocr(job, image_bytes, media_type)   # lectura ya conocida: sin modelo ni cola
+    else:
+        store["pool"].submit(_trabajo_ocr, job, image_bytes, media_type)
+    return job["id"]
+
+
+def _recuperar_ocr_colgados(casillero: str, df: pd.DataFrame) -> bool:
+    """Filas en "procesando" sin lectura viva (p. ej. el servidor se reinició) pasan a revisión manual."""
+    if df.empty:
         return False
-    for _, row in df.iterrows():
-        for comp in _parse_comprobantes(row.get("Comprobantes")):
-            if (_norm_cta(comp.get("cuenta")) == cta
-                    and _norm_txt(comp.get("referencia")) == ref
-                    and _norm_txt(comp.get("fecha")) == fch
-                    and _norm_monto(comp.get("monto")) == mto):
-                return True
-    return False
+    def _procesando(d: pd.DataFrame) -> set:
+        return set(d.loc[d["Estado"].astype(str).str.strip().str.lower() == "procesando", "ID"].astype(str))
+
+    candidatas = _procesando(df) - _ocr_activos(casillero)
+    if not candidatas:
+        return False
+    store = _ocr_store()
+    with store["lock"]:
+        lock_cas = store["casilleros"].setdefault(casillero, threading.Lock())
+    with lock_cas:
+        # Se relee bajo el mismo candado con que los trabajos guardan su resultado: el DF de la
+        # sesión pudo quedar viejo mientras una lectura terminaba (y no se debe pisar lo que guardó)
+        huerfanas = (candidatas & _procesando(load_consignaciones(casillero))) - _ocr_activos(casillero)
+        for cid in huerfanas:
+            _update_consignacion(casillero, cid, {"Estado": "en revision"})
+    return bool(huerfanas)
+
+
+@st.fragment(run_every=OCR_POLL_S)
+def _seguimiento_ocr() -> None:
+    """Consulta la cola para los trabajos de esta sesión; al terminar alguno recarga la página."""
+    store = _ocr_store()
+    ids = st.session_state.get("ocr_jobs", [])
+    terminados = []
+    for jid in ids:
+        job = store["jobs"].get(jid)
+        if job is None or job["estado"] == "listo":
+            terminados.append(jid)
+        else:
+            st.info(f"⏳ Leyendo el comprobante de {job['ID']}… puedes seguir usando la página.")
+    if terminados:
+        mensajes = st.session_state.setdefault("ocr_mensajes", [])
+        with store["lock"]:
+            for jid in terminados:
+                job = store["jobs"].pop(jid, None)
+                if job and job.get("error"):
+                    mensajes.append((
+                        "error",
+                        f"❌ {job['ID']}: no se pudo registrar la lectura del comprobante ({job['error']}). "
+                        "Quedó en revisión del administrador.",
+                    ))
+                elif job and job["resultado"]:
+                    mensajes.append(job["resultado"])
+        st.session_state["ocr_jobs"] = [j for j in ids if j not in terminados]
+        st.rerun()
 
 
 # 3) Diccionario de claves por hoja
@@ -534,12 +2139,8 @@ st.sidebar.title("🔒 Acceso Mayorista")
 
 # 🔄 Botón de refresco manual
 if st.sidebar.button("🔄 Refrescar datos"):
-    # Limpia cachés
-    load_data.clear()
-    try:
-        load_ingresos_con_id.clear()  # solo si la decoraste con @st.cache_data
-    except Exception:
-        pass
+    # Revalida contra Dropbox: solo se descarga de nuevo lo que cambió (rev/content_hash)
+    _olvidar_metadata()
     st.session_state.pop("ingresos_id_archivos", None)
     st.rerun()
 
@@ -547,6 +2148,7 @@ if st.sidebar.button("🔄 Refrescar datos"):
 password = st.sidebar.text_input("Introduce tu clave", type="password")
 if not password:
     st.sidebar.warning("Debes introducir tu clave para continuar")
+    _marcar_render("login")
     st.stop()
 if password not in PASSWORDS:
     st.sidebar.error("Clave incorrecta")
@@ -569,7 +2171,10 @@ if sheet_name == ADMIN_SHEET:
     )
     st.caption(f"Gestión de consignaciones — {CASILLEROS[cas_sel]} (casillero {cas_sel})")
 
-    df_consig = load_consignaciones(cas_sel)
+    df_consig, ver_consig = _consignaciones_y_version(cas_sel)
+    if _recuperar_ocr_colgados(cas_sel, df_consig):
+        df_consig, ver_consig = _consignaciones_y_version(cas_sel)
+    comp_adm = load_comprobantes(cas_sel)
 
     # ---- (A) Crear consignación ----
     with st.container(border=True):
@@ -602,8 +2207,7 @@ if sheet_name == ADMIN_SHEET:
                     "Monto abonado":    0,
                 }
                 df_new = pd.concat([df_consig, pd.DataFrame([nueva])], ignore_index=True)
-                if _save_consignaciones_to_dropbox(df_new, cas_sel):
-                    load_consignaciones.clear()
+                if _save_consignaciones_to_dropbox(df_new, cas_sel, ver_consig):
                     st.success(f"✅ Consignación {nueva['ID']} creada para {CASILLEROS[cas_sel]} (estado: pendiente).")
                     st.rerun()
 
@@ -634,7 +2238,7 @@ if sheet_name == ADMIN_SHEET:
                 st.error("Completa monto y número de cuenta.")
             else:
                 egreso = round(float(ret_monto) * (1 + float(ret_com) / 100.0), 2)
-                df_b = load_consignaciones(ret_b)
+                df_b, ver_b = _consignaciones_y_version(ret_b)
                 hoy = pd.Timestamp.now().strftime("%Y-%m-%d")
                 nueva = {
                     "ID":               _next_consignacion_id(df_b),
@@ -655,8 +2259,7 @@ if sheet_name == ADMIN_SHEET:
                     "Egreso retiro":    egreso,
                 }
                 df_new = pd.concat([df_b, pd.DataFrame([nueva])], ignore_index=True)
-                if _save_consignaciones_to_dropbox(df_new, ret_b):
-                    load_consignaciones.clear()
+                if _save_consignaciones_to_dropbox(df_new, ret_b, ver_b):
                     st.success(
                         f"✅ Retiro {nueva['ID retiro']} creado: {CASILLEROS[ret_a]} retira "
                         f"${float(ret_monto):,.0f} (egreso ${egreso:,.0f}). "
@@ -673,46 +2276,83 @@ if sheet_name == ADMIN_SHEET:
         st.dataframe(df_consig[cols_vista], use_container_width=True)
 
         # Descargar el comprobante de CUALQUIER consignación (auditar/validar)
-        con_comp = df_consig[df_consig["Comprobantes"].map(lambda x: len(_parse_comprobantes(x)) > 0)]
+        con_comp = df_consig[df_consig["ID"].astype(str).isin(comp_adm["por_id"].keys())]
         if not con_comp.empty:
             with st.expander("📥 Ver / descargar comprobantes de cualquier consignación"):
-                for _, r in con_comp.iterrows():
-                    rid = str(r["ID"])
-                    for i, comp in enumerate(_parse_comprobantes(r.get("Comprobantes")), 1):
-                        st.markdown(
-                            f"**{rid}** · comp {i} · ${(_norm_monto(comp.get('monto')) or 0):,.0f} · "
-                            f"cuenta {comp.get('cuenta','')} · ref {comp.get('referencia','')} · {r['Estado']}"
-                        )
-                        img = _download_comprobante_bytes(comp.get("ruta", ""))
-                        if img:
-                            st.image(img, width=260)
-                            fname = (comp.get("ruta", "") or f"{rid}_{i}").split("/")[-1] or f"{rid}_{i}.jpg"
-                            st.download_button(
-                                "⬇️ Descargar",
-                                data=img,
-                                file_name=fname,
-                                mime=("image/png" if fname.lower().endswith(".png") else "image/jpeg"),
-                                key=f"dlall_{rid}_{i}",
-                            )
-                        else:
-                            st.caption("(No se pudo previsualizar este comprobante.)")
+                estados = dict(zip(con_comp["ID"].astype(str), con_comp["Estado"]))
+                todos = [
+                    (rid, i, comp)
+                    for rid in con_comp["ID"].astype(str)
+                    for i, comp in enumerate(comp_adm["por_id"][rid], 1)
+                ]
+                pagina = _paginar(todos, key=f"pag_all_{cas_sel}")
+                # Una sola consulta de metadata para toda la página (misma carpeta de comprobantes)
+                try:
+                    _metadata_por_listado([c.get("ruta", "") for _, _, c in pagina if c.get("ruta")])
+                except Exception:
+                    pass
+                for rid, i, comp in pagina:
+                    st.markdown(
+                        f"**{rid}** · comp {i} · ${(_norm_monto(comp.get('monto')) or 0):,.0f} · "
+                        f"cuenta {comp.get('cuenta','')} · ref {comp.get('referencia','')} · {estados[rid]}"
+                    )
+                    _mostrar_comprobante(comp.get("ruta", ""), key=f"dlall_{rid}_{i}", nombre=f"{rid}_{i}", width=260)
 
     # ---- (C) Requieren revisión del admin: pagos parciales o no legibles ----
     st.subheader("🔎 Requieren tu revisión (parciales / no leídas)")
+    for nivel, msg in st.session_state.pop("lote_mensajes", []):
+        getattr(st, nivel)(msg)
     rev = df_consig[df_consig["Estado"].astype(str).str.strip().str.lower().isin(["parcial", "en revision"])]
+
+    # Decisión en lote: lo marcado en cualquier casillero se aplica con una escritura por casillero
+    lote = {c: ids for c, ids in _lote_revision().items() if ids}
+    if lote:
+        with st.container(border=True):
+            st.markdown(
+                f"**Selección para decidir en lote:** {sum(map(len, lote.values()))} consignación(es) — "
+                + " · ".join(f"{CASILLEROS.get(c, c)}: {', '.join(ids)}" for c, ids in lote.items())
+            )
+            lb1, lb2, lb3 = st.columns(3)
+            accion = None
+            if lb1.button("✅ Aprobar seleccionadas", key="lote_aprobar", use_container_width=True):
+                accion = "aprobada"
+            if lb2.button("❌ Rechazar seleccionadas", key="lote_rechazar", use_container_width=True):
+                accion = "rechazada"
+            if lb3.button("Limpiar selección", key="lote_limpiar", use_container_width=True):
+                st.session_state["lote_revision"] = {}
+                st.rerun()
+            if accion:
+                # 🚧 PENDIENTE (igual que el botón individual): el append al histórico sigue desactivado.
+                st.session_state["lote_mensajes"] = _aplicar_lote_revision(accion)
+                st.rerun()
+
     if rev.empty:
         st.caption("Nada pendiente de revisión (lo demás se aprobó/rechazó automáticamente).")
     else:
-        for _, row in rev.iterrows():
+        pagina_rev = _paginar(rev.to_dict("records"), key=f"pag_rev_{cas_sel}")
+        sel_cas = _lote_revision().get(cas_sel, [])
+        if st.button("☑️ Seleccionar todas las de esta página", key=f"sel_pag_{cas_sel}"):
+            _lote_revision()[cas_sel] = list(dict.fromkeys(sel_cas + [str(r["ID"]) for r in pagina_rev]))
+            st.rerun()
+        try:
+            _metadata_por_listado([
+                c.get("ruta", "") for r in pagina_rev for c in comp_adm["por_id"].get(str(r["ID"]), []) if c.get("ruta")
+            ])
+        except Exception:
+            pass
+        for _, row in pd.DataFrame(pagina_rev).iterrows():
             cid = str(row["ID"])
             estado = str(row["Estado"])
             solicitado = float(pd.to_numeric(row["Monto"], errors="coerce") or 0)
-            comps = _parse_comprobantes(row.get("Comprobantes"))
-            abonado = sum(_norm_monto(c.get("monto")) or 0 for c in comps)
+            comps = comp_adm["por_id"].get(cid, [])
+            abonado = comp_adm["abonado"].get(cid, 0.0)
             with st.container(border=True):
-                st.markdown(
+                st.checkbox(
                     f"**{cid}** — {row['Descripcion']} — solicitado ${solicitado:,.0f} — "
-                    f"{row['Tipo']} — `{estado}`"
+                    f"{row['Tipo']} — `{estado}`",
+                    value=cid in sel_cas,
+                    key=f"sel_{cas_sel}_{cid}_{cid in sel_cas}",
+                    on_change=_alternar_seleccion, args=(cas_sel, cid),
                 )
                 st.caption(
                     f"Cuenta solicitada: {row['Numero de cuenta']} · "
@@ -727,17 +2367,9 @@ if sheet_name == ADMIN_SHEET:
                         f"cuenta {comp.get('cuenta','')} · ref {comp.get('referencia','')} · "
                         f"fecha {comp.get('fecha','')}"
                     )
-                    img = _download_comprobante_bytes(comp.get("ruta", ""))
-                    if img:
-                        st.image(img, width=300)
-                        fname = (comp.get("ruta", "") or f"{cid}_{i}").split("/")[-1] or f"{cid}_{i}.jpg"
-                        st.download_button(
-                            "⬇️ Descargar comprobante",
-                            data=img,
-                            file_name=fname,
-                            mime=("image/png" if fname.lower().endswith(".png") else "image/jpeg"),
-                            key=f"dl_{cid}_{i}",
-                        )
+                    if comp.get("posible_duplicado"):
+                        st.warning(f"⚠️ Imagen idéntica a una ya enviada ({comp['posible_duplicado']}).")
+                    _mostrar_comprobante(comp.get("ruta", ""), key=f"dl_{cid}_{i}", nombre=f"{cid}_{i}", width=300)
 
                 bc1, bc2 = st.columns(2)
                 if bc1.button("✅ Aprobar", key=f"apr_{cid}", use_container_width=True):
@@ -759,6 +2391,21 @@ if sheet_name == ADMIN_SHEET:
                         st.warning(f"❌ {cid} rechazada.")
                         st.rerun()
 
+    _marcar_render("admin")
+
+    # ---- (D) Diagnóstico de rendimiento del servidor ----
+    with st.expander("📊 Diagnóstico de rendimiento"):
+        st.markdown("**Caché compartido (todas las sesiones)**")
+        st.dataframe(pd.DataFrame([_cache_compartido().stats()]), use_container_width=True, hide_index=True)
+        st.markdown("**Memoria del histórico cacheado (por hoja)**")
+        st.dataframe(_reporte_memoria(), use_container_width=True, hide_index=True)
+        st.markdown("**Cola de lectura de comprobantes (OCR)**")
+        st.dataframe(pd.DataFrame([_estado_cola_ocr()]), use_container_width=True, hide_index=True)
+        st.markdown("**Últimos comprobantes subidos (normalización de imagen)**")
+        st.dataframe(_reporte_comprobantes(), use_container_width=True, hide_index=True)
+        st.markdown("**Tiempos del proceso (inicio del script → primer render)**")
+        st.dataframe(_reporte_metricas(), use_container_width=True, hide_index=True)
+
     st.stop()
 
 df = load_data(sheet_name)
@@ -781,27 +2428,6 @@ casillero_actual = SHEET_TO_CAS.get(sheet_name)
 # Casillero para CONSIGNACIONES/RETIROS: por defecto el real, salvo usuarios de prueba (aislados).
 cas_consig = CONSIG_CASILLERO_OVERRIDE.get(password, casillero_actual)
 
-# 🚚 Carga silenciosa de IngresosConID a sesión (sin renderizar)
-if casillero_actual:
-    loaded = load_ingresos_con_id(casillero_actual)  # puede venir cacheado
-    existing = st.session_state.get("ingresos_id_archivos", {}) or {}
-    # Merge: lo que ya esté en sesión (p.ej., Clientes editados) GANA sobre lo cacheado
-    merged = {**loaded, **existing}
-    st.session_state["ingresos_id_archivos"] = merged
-else:
-    st.session_state["ingresos_id_archivos"] = {}
-
-
-
-# 👉 Solo si es Maria Moises: cargar la hoja en COP adicional
-df_cop = None
-if sheet_name == "Maria Moises 2025":
-    try:
-        df_cop = load_data("1444 - Maria Moises COP")
-    except Exception as e:
-        st.error(f"⚠️ No se pudo cargar la hoja en COP histórico: {e}")
-        
-        
 st.header(f"📋 Conciliaciones: {sheet_name}")
 
 # 6) Mostrar fecha de última actualización
@@ -843,7 +2469,7 @@ else:
 
 # 💡 SALDO EN VIVO: total oficial + consignaciones/retiros APROBADOS aún no cargados al histórico.
 #    Cuando el generador los carga (Orden presente en el histórico) dejan de contar -> no se duplica.
-ping, pegr = _pendientes_saldo(cas_consig, df) if cas_consig else (0.0, 0.0)
+ping, pegr, pend_detalle = _pendientes_saldo(cas_consig, sheet_name) if cas_consig else (0.0, 0.0, None)
 saldo_vivo = base_tot + ping - pegr
 color = "green" if saldo_vivo >= 0 else "red"
 
@@ -862,6 +2488,12 @@ if ping or pegr:
         f"En vivo: incluye +${ping:,.0f} de consignaciones aprobadas y −${pegr:,.0f} de retiros "
         f"aún no cargados al histórico. (Total oficial cargado: ${base_tot:,.0f}.)"
     )
+    with st.expander("Detalle del saldo en vivo"):
+        st.dataframe(
+            pend_detalle.assign(Monto=pend_detalle["Monto"].map(lambda x: f"${x:,.0f}")),
+            use_container_width=True, hide_index=True,
+        )
+_marcar_render("saldo")
 
 
 # 🧾 Sección "Ingresos por consignaciones" — para cualquier mayorista (su propio casillero)
@@ -870,6 +2502,16 @@ if cas_consig:
     st.header("🧾 Ingresos por consignaciones")
 
     df_consig_m = load_consignaciones(cas_consig)
+    if _recuperar_ocr_colgados(cas_consig, df_consig_m):
+        df_consig_m = load_consignaciones(cas_consig)
+    comp_m = load_comprobantes(cas_consig)
+
+    # Seguimiento de las lecturas en cola y resultados de las terminadas (el seguimiento va
+    # primero: si recarga la página, los mensajes se muestran en la siguiente ejecución)
+    if st.session_state.get("ocr_jobs"):
+        _seguimiento_ocr()
+    for nivel, msg in st.session_state.pop("ocr_mensajes", []):
+        getattr(st, nivel)(msg)
     if df_consig_m.empty:
         st.info("No tienes consignaciones asignadas todavía.")
     else:
@@ -884,6 +2526,11 @@ if cas_consig:
         abiertas = df_consig_m[
             df_consig_m["Estado"].astype(str).str.strip().str.lower().isin(["pendiente", "parcial"])
         ]
+        en_proceso = df_consig_m.loc[
+            df_consig_m["Estado"].astype(str).str.strip().str.lower() == "procesando", "ID"
+        ].astype(str).tolist()
+        if en_proceso:
+            st.caption(f"⏳ Leyendo comprobante: {', '.join(en_proceso)}")
         if abiertas.empty:
             st.caption("No tienes consignaciones por pagar.")
         else:
@@ -891,8 +2538,8 @@ if cas_consig:
                 cid = str(row["ID"])
                 solicitado = float(pd.to_numeric(row["Monto"], errors="coerce") or 0)
                 cuenta_sol = str(row["Numero de cuenta"])
-                comps = _parse_comprobantes(row.get("Comprobantes"))
-                abonado = sum(_norm_monto(c.get("monto")) or 0 for c in comps)
+                comps = comp_m["por_id"].get(cid, [])
+                abonado = comp_m["abonado"].get(cid, 0.0)
                 falta = max(solicitado - abonado, 0)
                 with st.container(border=True):
                     st.markdown(
@@ -916,69 +2563,13 @@ if cas_consig:
                         if upl is None:
                             st.error("Debes adjuntar una imagen.")
                         else:
-                            hoy = pd.Timestamp.now().strftime("%Y-%m-%d")
-                            fr_actual = str(row.get("Fecha realizado") or "").strip()
-                            primera = (not fr_actual or fr_actual.lower() == "nan")
-                            image_bytes = upl.getvalue()
-                            media_type = upl.type or "image/png"
-                            ruta = _upload_comprobante(cas_consig, cid, upl)
+                            comp = _normalizar_comprobante(upl.getvalue(), upl.type or "image/png", upl.name)
+                            ruta = _upload_comprobante(cas_consig, cid, comp)
                             if ruta:
-                                datos, err = _extraer_datos_comprobante(image_bytes, media_type)
-
-                                if datos is None:
-                                    # La IA no pudo leer -> revisión manual del admin
-                                    upd = {"Estado": "en revision"}
-                                    if primera:
-                                        upd["Fecha realizado"] = hoy
-                                    if _update_consignacion(cas_consig, cid, upd):
-                                        st.warning("📎 No se pudo procesar el comprobante automáticamente. Quedó en revisión del administrador.")
-                                        st.rerun()
-                                else:
-                                    cta_comp = datos.get("cuenta_destino", "")
-                                    cuenta_ok = (_norm_cta(cuenta_sol) == "" or _norm_cta(cta_comp) == _norm_cta(cuenta_sol))
-                                    # Mensajes genéricos al mayorista: NO se exponen las reglas internas
-                                    # (cuenta esperada, montos, referencias). El admin sí ve el detalle.
-                                    if not datos.get("es_transferencia_exitosa", True):
-                                        st.error("No se pudo registrar este comprobante. Verifica que sea correcto o contacta al administrador.")
-                                    elif not cuenta_ok:
-                                        st.error("No se pudo registrar este comprobante. Verifica que sea correcto o contacta al administrador.")
-                                    elif _es_duplicado_global(load_consignaciones(cas_consig), cta_comp, datos.get("referencia"), datos.get("monto"), datos.get("fecha")):
-                                        st.error("⚠️ Este comprobante ya fue usado anteriormente. No se puede registrar de nuevo.")
-                                    else:
-                                        comp_nuevo = {
-                                            "ruta": ruta,
-                                            "banco": datos.get("banco", ""),
-                                            "monto": _norm_monto(datos.get("monto")) or 0,
-                                            "fecha": datos.get("fecha", ""),
-                                            "cuenta": cta_comp,
-                                            "referencia": datos.get("referencia", ""),
-                                        }
-                                        comps_new = comps + [comp_nuevo]
-                                        abonado_new = sum(_norm_monto(c.get("monto")) or 0 for c in comps_new)
-                                        upd = {
-                                            "Comprobantes": json.dumps(comps_new, ensure_ascii=False),
-                                            "Monto abonado": abonado_new,
-                                        }
-                                        if primera:
-                                            upd["Fecha realizado"] = hoy
-
-                                        if solicitado > 0 and abonado_new >= solicitado:
-                                            # Cubre el total -> aprobación automática (sin tocar el histórico)
-                                            upd["Estado"] = "aprobada"
-                                            upd["Fecha decision"] = hoy
-                                            if _update_consignacion(cas_consig, cid, upd):
-                                                st.success(f"✅ Pago COMPLETO (${abonado_new:,.0f}). Aprobado automáticamente.")
-                                                st.rerun()
-                                        else:
-                                            # Falta dinero -> pago parcial; el admin debe verlo si no completa
-                                            upd["Estado"] = "parcial"
-                                            if _update_consignacion(cas_consig, cid, upd):
-                                                falta_new = max(solicitado - abonado_new, 0)
-                                                st.warning(
-                                                    f"💸 Abonado ${abonado_new:,.0f} de ${solicitado:,.0f}. "
-                                                    f"Te falta ${falta_new:,.0f}. ¿Adjuntas otro comprobante para completar?"
-                                                )
-                                                st.rerun()
+                                jid = _encolar_ocr(cas_consig, row, ruta, comp["data"], comp["media_type"])
+                                if jid:
+                                    st.session_state.setdefault("ocr_jobs", []).append(jid)
+                                    st.rerun()
 
 
 # 🏧 Sección "Mis retiros (egresos)" — lo que ESTE mayorista retira (se le carga como egreso)
@@ -997,7 +2588,7 @@ if cas_consig:
         est = retiros_mios["Estado"].astype(str).str.strip().str.lower()
         # El egreso SOLO cuenta cuando el comprobante del retiro está APROBADO.
         egreso_confirmado = eg[est == "aprobada"].sum()
-        egreso_pendiente = eg[est.isin(["pendiente", "parcial", "en revision"])].sum()
+        egreso_pendiente = eg[est.isin(["pendiente", "parcial", "procesando", "en revision"])].sum()
         c1, c2 = st.columns(2)
         c1.metric("Egresos confirmados (comprobante aprobado)", f"${egreso_confirmado:,.0f}")
         c2.metric("Pendientes por aprobar", f"${egreso_pendiente:,.0f}")
@@ -1030,6 +2621,7 @@ if sheet_name == "1444 - Maria Moises" and 'TRM' in df.columns:
     cols_in.append('TRM')
 
 df_in = df.loc[df['Tipo'] == 'Ingreso', cols_in].copy()
+df_in['Motivo'] = df_in['Motivo'].astype(object)  # viene como category; abajo se reescribe
 
 if df_in.empty:
     st.info("Aún no hay ingresos para mostrar.")
@@ -1195,7 +2787,17 @@ with c2:
 
 
 
-# 👉 Crear df_eg_extra_cop solo para Maria Moises
+# 👉 Solo si es Maria Moises: hoja en COP adicional, bajo demanda (no frena el saldo)
+df_cop = None
+if sheet_name == "Maria Moises 2025" and st.toggle("🪙 Ver egresos extra en COP", key="ver_cop"):
+    try:
+        df_cop = load_data(
+            "1444 - Maria Moises COP",
+            columns=['Fecha', 'Descripcion', 'Egreso_extra_COP', 'GMF_4x1000_COP'],
+        )
+    except Exception as e:
+        st.error(f"⚠️ No se pudo cargar la hoja en COP histórico: {e}")
+
 # 👉 Crear df_eg_extra_cop solo para Maria Moises
 df_eg_extra_cop = None
 if sheet_name == "Maria Moises 2025" and df_cop is not None:
@@ -1240,6 +2842,195 @@ if sheet_name == "Maria Moises 2025" and df_cop is not None:
 
 
 
+# ——————————————————————————————
+# 9) Gráficas (bajo demanda): se dibujan UNA vez por versión del histórico y filtro,
+#    se guardan como PNG en el caché compartido y solo se calculan si se abren.
+# ——————————————————————————————
+def _fig_png(fig) -> bytes:
+    import matplotlib.pyplot as plt
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return buf.getvalue()
+
+
+@_memo_compartido
+def _graficas_historico(path: str, version: str, sheet: str, desde: str) -> list[dict]:
+    """Las 4 gráficas del final: lista de {titulo, png | info | error}."""
+    import matplotlib.pyplot as plt  # solo aquí: el login y el saldo no cargan matplotlib
+    import matplotlib.ticker as mtick
+    df = _load_sheet(path, version, sheet)
+    df = df[df['Fecha de Carga'] >= pd.Timestamp(desde)]
+    out = []
+
+    # 9.1️⃣ Evolución del saldo reportado (#4)
+    g = {"titulo": "4️⃣ Evolución del saldo reportado"}
+    try:
+        df_tot = df[df['Tipo']=='Total']
+        if df_tot.empty:
+            g["info"] = "Aún no hay movimientos totales para mostrar."
+        else:
+            df_tot = df_tot.copy()
+            # asegurar tipos
+            df_tot['Fecha de Carga'] = pd.to_datetime(df_tot['Fecha de Carga'], errors='coerce')
+            df_tot['Monto'] = pd.to_numeric(df_tot['Monto'], errors='coerce')
+
+            # tomar las 7 fechas de carga más recientes (distintas)
+            fechas_recientes = (
+                df_tot['Fecha de Carga']
+                .dt.normalize()            # sólo la fecha (sin hora)
+                .dropna()
+                .drop_duplicates()
+                .sort_values(ascending=False)
+                .head(7)
+            )
+            # filtrar al conjunto de esas 7 fechas
+            df_tot = df_tot[df_tot['Fecha de Carga'].dt.normalize().isin(set(fechas_recientes))]
+            # ordenar por fecha para que la línea salga prolija
+            df_tot = df_tot.sort_values('Fecha de Carga')
+
+            fig, ax = plt.subplots(figsize=(8,4))
+
+            # 1) línea gris de fondo
+            ax.plot(df_tot['Fecha de Carga'], df_tot['Monto'],
+                    linestyle='-', color='lightgrey', linewidth=1)
+
+            # 2) marcadores individuales coloreados
+            for _, row in df_tot.iterrows():
+                pt_color = 'green' if row['Monto'] >= 0 else 'red'
+                ax.scatter(row['Fecha de Carga'], row['Monto'], color=pt_color, s=50, zorder=3)
+
+            ax.set_title("Conciliación por día")
+            ax.set_xlabel("Fecha de Carga")
+            ax.set_ylabel("Saldo")
+            ax.yaxis.set_major_formatter(mtick.StrMethodFormatter('${x:,.0f}'))
+
+            # 3) anotaciones desplazadas
+            for _, row in df_tot.iterrows():
+                ann_color = 'green' if row['Monto'] >= 0 else 'red'
+                label = f"{row['Fecha de Carga'].date()}\n${row['Monto']:,.0f}"
+                offset = 30 if row['Monto'] >= 0 else -30
+                ax.annotate(
+                    label,
+                    xy=(row['Fecha de Carga'], row['Monto']),
+                    xytext=(0, offset),
+                    textcoords="offset points",
+                    fontsize=8,
+                    ha='center',
+                    color=ann_color
+                )
+
+            g["png"] = _fig_png(fig)
+    except Exception as e:
+        g["error"] = f"⚠️ Error sección Evolución del saldo: {e}"
+    out.append(g)
+
+    # 9.2️⃣ Cantidad de compras (últimos 7 días) (#5)
+    g = {"titulo": "5️⃣ Cantidad de compras (últimos 7 días)"}
+    df_eg2 = pd.DataFrame()
+    try:
+        df_eg2 = df[df['Tipo']=='Egreso'].copy()
+        if df_eg2.empty:
+            g["info"] = "Aún no hay compras para el cálculo de los últimos 7 días."
+        else:
+            df_eg2['Fecha'] = pd.to_datetime(df_eg2['Fecha'])
+            max_f = df_eg2['Fecha'].max()
+            min_f = max_f - pd.Timedelta(days=6)
+            conteo = df_eg2[(df_eg2['Fecha'] >= min_f) & (df_eg2['Fecha'] <= max_f)].groupby('Fecha').size()
+            if conteo.empty:
+                g["info"] = "No hay compras en los últimos 7 días."
+            else:
+                fig2, ax2 = plt.subplots(figsize=(8,4))
+                ax2.plot(conteo.index, conteo.values, marker='o', color='green')
+                ax2.set_title(f"Cantidad de compras: {min_f.date()} al {max_f.date()}")
+                ax2.set_xlabel("Fecha")
+                ax2.set_ylabel("Cantidad de compras")
+                ax2.set_ylim(0, conteo.max() + 5)
+                for fecha, val in conteo.items():
+                    ax2.text(fecha, val + 0.5, str(val), fontsize=8, ha='center', color='green')
+                g["png"] = _fig_png(fig2)
+    except Exception as e:
+        g["error"] = f"⚠️ Error sección Cantidad de compras: {e}"
+    out.append(g)
+
+    # 9.3️⃣ Valor total de compras (últimos 7 días) (#6)
+    g = {"titulo": "6️⃣ Valor total de compras (últimos 7 días)"}
+    try:
+        if df_eg2.empty:
+            g["info"] = "Sin datos de egresos para valores totales."
+        else:
+            suma = df_eg2[(df_eg2['Fecha'] >= min_f) & (df_eg2['Fecha'] <= max_f)].groupby('Fecha')['Monto'].sum()
+            if suma.empty or pd.isna(suma.max()):
+                g["info"] = "No hay valor de compras en los últimos 7 días."
+            else:
+                fig3, ax3 = plt.subplots(figsize=(8,4))
+                ax3.plot(suma.index, suma.values, marker='o', color='green')
+                ax3.set_title(f"Valor de compras: {min_f.date()} al {max_f.date()}")
+                ax3.set_xlabel("Fecha")
+                ax3.set_ylabel("Monto acumulado")
+                ax3.yaxis.set_major_formatter(mtick.StrMethodFormatter('${x:,.0f}'))
+                ax3.set_ylim(0, suma.max() * 1.25)
+                rango_s = suma.max() - suma.min() if suma.max() != suma.min() else suma.max()
+                for fecha, val in suma.items():
+                    desplaz = max(rango_s * 0.1, suma.max() * 0.05)
+                    ax3.text(fecha, val + desplaz, f"${val:,.0f}", fontsize=8, ha='center', color='green')
+                g["png"] = _fig_png(fig3)
+    except Exception as e:
+        g["error"] = f"⚠️ Error sección Valor total de compras: {e}"
+    out.append(g)
+
+    # 9.4️⃣ Ingresos últimos 7 días (#7)
+    g = {"titulo": "7️⃣ Ingresos últimos 7 días"}
+    try:
+        df_in2 = df[df['Tipo']=='Ingreso'].copy()
+        if df_in2.empty:
+            g["info"] = "Aún no tenemos movimientos de ingresos."
+        else:
+            df_in2['Fecha'] = pd.to_datetime(df_in2['Fecha'])
+            max_i = df_in2['Fecha'].max()
+            min_i = max_i - pd.Timedelta(days=6)
+            suma_i = df_in2[(df_in2['Fecha'] >= min_i) & (df_in2['Fecha'] <= max_i)].groupby('Fecha')['Monto'].sum()
+            if suma_i.empty or pd.isna(suma_i.max()):
+                g["info"] = "Aún no tenemos ingresos en los últimos 7 días."
+            else:
+                fig4, ax4 = plt.subplots(figsize=(8,4))
+                ax4.plot(suma_i.index, suma_i.values, marker='o', color='green')
+                ax4.set_title(f"Ingresos: {min_i.date()} al {max_i.date()}")
+                ax4.set_xlabel("Fecha")
+                ax4.set_ylabel("Monto acumulado")
+                ax4.yaxis.set_major_formatter(mtick.StrMethodFormatter('${x:,.0f}'))
+                ax4.set_ylim(0, suma_i.max() * 1.2)
+                rng_i = suma_i.max() - suma_i.min() if suma_i.max() != suma_i.min() else suma_i.max()
+                for fecha, val in suma_i.items():
+                    d = max(rng_i * 0.1, suma_i.max() * 0.05)
+                    ax4.text(fecha, val + d, f"${val:,.0f}", fontsize=8, ha='center', color='green')
+                g["png"] = _fig_png(fig4)
+    except Exception as e:
+        g["error"] = f"⚠️ Error sección Ingresos últimos 7 días: {e}"
+    out.append(g)
+    return out
+
+
+def _seccion_graficas() -> None:
+    """Gráficas #4–#7 detrás de un interruptor (el estado se recuerda en la sesión)."""
+    st.markdown("---")
+    if not st.toggle("📈 Ver gráficas", key="ver_graficas"):
+        st.caption("Evolución del saldo, compras e ingresos de los últimos 7 días.")
+        return
+    path = cfg_dbx["remote_path"]
+    with st.spinner("Dibujando gráficas..."):
+        graficas = _graficas_historico(path, _dropbox_version(path), sheet_name, str(start_date.date()))
+    for g in graficas:
+        st.header(g["titulo"])
+        if "error" in g:
+            st.error(g["error"])
+        elif "info" in g:
+            st.info(g["info"])
+        else:
+            with st.columns([1,2,1])[1]:
+                st.image(g["png"], use_container_width=True)
+
+
 ############################################ FACTURACION##############################################################
 
 
@@ -1262,6 +3053,12 @@ if casillero_actual not in FACT_CAS_ALLOW:
     st.info("📌 El módulo de facturación solo está disponible para 9680, 13608, 1633 y 1444.")
     st.stop()
 
+# 💤 Facturación bajo demanda: Clientes e IngresosConID solo se cargan al abrir el módulo
+if not st.toggle("Abrir módulo de facturación", key="abrir_facturacion"):
+    st.caption("Actívalo para cargar clientes e ingresos con ID.")
+    _seccion_graficas()
+    st.stop()
+
 # -------------------- A PARTIR DE AQUÍ FACTURACIÓN ACTIVA --------------------
 
 df_clientes: pd.DataFrame | None = None
@@ -1270,6 +3067,11 @@ if not casillero_actual:
     st.error("No se pudo identificar el casillero actual para facturación.")
     st.stop()
 
+# 🚚 Carga de IngresosConID a sesión (sin renderizar)
+# Referencias al caché compartido (no copias). Ya viene validado por versión: lo que esta
+# sesión guardó en Dropbox aparece aquí en el siguiente rerun, sin mezclar con la sesión.
+st.session_state["ingresos_id_archivos"] = load_ingresos_con_id(casillero_actual)
+
 # 1) Buscar en memoria (ej.: Clientes_1633.xlsx)
 ingresos_id_archivos = st.session_state.get("ingresos_id_archivos", {}) or {}
 key_clientes = next(
@@ -1405,7 +3207,7 @@ def _save_clientes_to_dropbox(df_to_save: pd.DataFrame) -> bool:
             cols_rest  = [c for c in df_to_save.columns if c not in cols_exist]
             df_to_save[cols_exist + cols_rest].to_excel(w, index=False, sheet_name="Clientes")
         buf_cli.seek(0)
-        dbx.files_upload(buf_cli.read(), clientes_path, mode=dropbox.files.WriteMode.overwrite)
+        _dbx_upload(buf_cli.read(), clientes_path)
         return True
     except Exception as e:
         st.error(f"❌ No se pudo guardar el archivo de clientes: {e}")
@@ -1497,12 +3299,8 @@ with st.container(border=True):
                             if ok:
                                 # Actualizar sesión con la versión más reciente
                                 silent = st.session_state.get("ingresos_id_archivos", {}) or {}
-                                silent[f"Clientes_{casillero_actual}.xlsx"] = df_clientes.copy()
+                                silent[f"Clientes_{casillero_actual}.xlsx"] = df_clientes
                                 st.session_state["ingresos_id_archivos"] = silent
-                                try:
-                                    load_ingresos_con_id.clear()  # limpiar caché de la carga silenciosa
-                                except Exception:
-                                    pass
                                 st.success("✅ Cliente guardado correctamente.")
                                 st.rerun()
 
@@ -1511,6 +3309,8 @@ with st.container(border=True):
 # ======================= (3) Ver tabla (SOLO si se busca + match exacto) ====================
 ing_sess = st.session_state.get("ingresos_id_archivos", {}) or {}
 df_clientes = ing_sess.get(f"Clientes_{casillero_actual}.xlsx", df_clientes)
+if df_clientes is not None and "_id_norm" not in df_clientes.columns and COL_ID in df_clientes.columns:
+    df_clientes = df_clientes.assign(_id_norm=df_clientes[COL_ID].map(norm_id).astype("string"))
 
 if df_clientes is None:
     df_clientes = pd.DataFrame(columns=REQUIRED_COLS)
@@ -1534,7 +3334,7 @@ with st.container():
         if df_mostrar.empty:
             st.info("No existe cliente con ese ID.")
         else:
-            st.dataframe(df_mostrar, use_container_width=True)
+            st.dataframe(_arrow_safe(df_mostrar), use_container_width=True)  # df_mostrar ya es copia
 
 # ===================== /FACTURACIÓN — CLIENTES =====================
 
@@ -1706,16 +3506,12 @@ else:
                         with pd.ExcelWriter(buf, engine="openpyxl") as w:
                             to_save.to_excel(w, index=False, sheet_name="Ingresos")
                         buf.seek(0)
-                        dbx.files_upload(buf.read(), fullpath, mode=dropbox.files.WriteMode.overwrite)
+                        _dbx_upload(buf.read(), fullpath)
                     except Exception as e:
                         st.error(f"❌ No se pudo guardar el archivo en Dropbox: {e}")
                     else:
-                        ing_arch[fname_sel] = df_ing_id.copy()
+                        ing_arch[fname_sel] = df_ing_id
                         st.session_state["ingresos_id_archivos"] = ing_arch
-                        try:
-                            load_ingresos_con_id.clear()
-                        except Exception:
-                            pass
                         st.success("✅ Cambios guardados en el archivo de IngresosConID.")
                         st.rerun()
 
@@ -1742,11 +3538,8 @@ if st.button("Preparar facturación", use_container_width=True):
         st.error("No se pudo identificar el casillero actual.")
     else:
         try:
-            # 1️⃣ Refrescar SIEMPRE la última versión desde Dropbox
-            try:
-                load_ingresos_con_id.clear()
-            except Exception:
-                pass
+            # 1️⃣ Validar SIEMPRE contra la última versión de Dropbox (solo baja lo que cambió)
+            _olvidar_metadata()
 
             ingresos_dict = load_ingresos_con_id(casillero_actual)  # SOLO archivos del casillero actual
 
@@ -1893,55 +3686,256 @@ SIIGO_BASE_URL = "https://api.siigo.com"
 NOMBRE_DE_MI_APP = "AutomatizacionFacturasEncargomio"
 
 
-def obtain_token() -> str | None:
-    """
-    Obtiene token de Siigo usando st.secrets["siigo"]["username"] y ["access_key"].
-    """
-    API_URL = f"{SIIGO_BASE_URL}/auth"
+SIIGO_TOKEN_TTL_S = 86400      # vigencia si /auth no trae expires_in (Siigo: 24 h)
+SIIGO_TOKEN_MARGEN_S = 600     # se renueva 10 min antes de vencer
 
-    credentials = {
-        "username": st.secrets["siigo"]["username"],
-        "access_key": st.secrets["siigo"]["access_key"],
-    }
 
-    headers = {
-        "Content-Type": "application/json",
-        "Partner-Id": NOMBRE_DE_MI_APP
-    }
+class SiigoTokenManager:
+    """
+    Token de acceso de Siigo compartido por todo el proceso (corridas y sesiones), con su
+    vencimiento: se reutiliza mientras sirva y se renueva antes de que venza.
+    """
 
-    try:
-        resp = requests.post(API_URL, json=credentials, headers=headers, timeout=30)
+    def __init__(self, cliente: "SiigoClient", credenciales: dict, margen_s: float = SIIGO_TOKEN_MARGEN_S):
+        self._cliente = cliente
+        self._credenciales = credenciales
+        self.margen_s = margen_s
+        self._lock = threading.Lock()
+        self.token = None
+        self.expira = 0.0
+        self._margen = margen_s
+        self.renovaciones = 0
+
+    def vigente(self) -> str | None:
+        with self._lock:
+            if self.token and time.time() < self.expira - self._margen:
+                return self.token
+            return self._renovar()
+
+    def invalidar(self, token: str) -> None:
+        """Descarta el token (p. ej. Siigo respondió 401) para que la próxima llamada pida otro."""
+        with self._lock:
+            if self.token == token:
+                self.token = None
+
+    def segundos_restantes(self) -> float:
+        return max(self.expira - time.time(), 0.0) if self.token else 0.0
+
+    def _renovar(self) -> str | None:
         try:
+            resp = self._cliente.post("/auth", json=self._credenciales)
             data = resp.json()
-        except json.JSONDecodeError:
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+        if resp.status_code != 200 or not data.get("access_token"):
             return None
+        vida = float(data.get("expires_in") or SIIGO_TOKEN_TTL_S)
+        self.token = data["access_token"]
+        self.expira = time.time() + vida
+        self._margen = min(self.margen_s, vida / 10)   # tokens de vida corta: margen proporcional
+        self.renovaciones += 1
+        _registrar_metrica("Siigo token: renovaciones", self.renovaciones)
+        return self.token
 
-        if resp.status_code == 200 and data.get("access_token"):
-            return data["access_token"]
 
-        return None
+class LimitadorSiigo:
+    """
+    Token bucket compartido por todas las llamadas a Siigo, adaptativo (AIMD): cada respuesta
+    normal sube un poco la tasa; cada límite (429 / requests_limit) la baja a la mitad y pausa
+    el cubo lo que diga Retry-After o, si no viene, un backoff exponencial con jitter.
+    """
 
-    except requests.exceptions.RequestException:
+    def __init__(self, tasa: float = 1.5, capacidad: float = 10, tasa_min: float = 0.2,
+                 tasa_max: float = 5.0, incremento: float = 0.05):
+        self.tasa = tasa                 # llamadas por segundo
+        self.capacidad = capacidad
+        self.tasa_min, self.tasa_max, self.incremento = tasa_min, tasa_max, incremento
+        self._lock = threading.Lock()
+        self._fichas = float(capacidad)
+        self._t = time.monotonic()
+        self._pausa_hasta = 0.0
+        self._racha = 0                  # límites seguidos (para el backoff)
+        self.limitadas = 0
+
+    def adquirir(self) -> None:
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                espera = self._pausa_hasta - ahora
+                if espera <= 0:
+                    self._fichas = min(self.capacidad, self._fichas + (ahora - self._t) * self.tasa)
+                    self._t = ahora
+                    if self._fichas >= 1:
+                        self._fichas -= 1
+                        return
+                    espera = (1 - self._fichas) / self.tasa
+            time.sleep(espera)
+
+    def exito(self) -> None:
+        with self._lock:
+            self._racha = 0
+            self.tasa = min(self.tasa_max, self.tasa + self.incremento)
+
+    def limitado(self, retry_after: float | None = None) -> float:
+        """Registra un límite del API. Devuelve los segundos de pausa aplicados."""
+        import random
+        with self._lock:
+            self._racha += 1
+            self.limitadas += 1
+            self.tasa = max(self.tasa_min, self.tasa / 2)
+            espera = retry_after if retry_after else min(60.0, 2.0 ** (self._racha - 1)) * (0.5 + random.random())
+            self._pausa_hasta = max(self._pausa_hasta, time.monotonic() + espera)
+            self._fichas = 0.0
+        _registrar_metrica("Siigo pausa por límite (s)", espera)
+        return espera
+
+    def backoff(self, intento: int, base: float = 2.0, tope: float = 60.0) -> float:
+        """Espera exponencial con jitter para errores transitorios que no son de límite."""
+        import random
+        espera = min(tope, base * 2 ** max(intento - 1, 0)) * (0.5 + random.random())
+        time.sleep(espera)
+        return espera
+
+
+def _retry_after(resp: requests.Response) -> float | None:
+    valor = (resp.headers.get("Retry-After") or "").strip()
+    if not valor:
+        return None
+    try:
+        return max(float(valor), 0.0)
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return max((parsedate_to_datetime(valor) - pd.Timestamp.now(tz="UTC")).total_seconds(), 0.0)
+    except Exception:
         return None
 
 
+SIIGO_REINTENTOS_LIMITE = 5     # reintentos de una llamada que Siigo frenó por límite
 
 
+class SiigoClient:
+    """
+    Cliente HTTP de Siigo sobre una sola requests.Session: las conexiones a api.siigo.com se
+    reutilizan (keep-alive, sin repetir el handshake TLS en cada llamada), los headers comunes
+    se arman una vez y cada endpoint lleva su conteo y latencia.
+    """
+
+    def __init__(self, base_url: str = SIIGO_BASE_URL, partner_id: str = NOMBRE_DE_MI_APP,
+                 timeout: tuple = (5, 30), pool: int = 8):
+        from requests.adapters import HTTPAdapter
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=pool, pool_maxsize=pool))
+        self.session.headers.update({"Content-Type": "application/json", "Partner-Id": partner_id})
+        self._lock = threading.Lock()
+        self._stats = {}   # "GET /v1/customers" -> {"llamadas", "errores", "ms_total", "ms_max"}
+        self.tokens: SiigoTokenManager | None = None
+        self.limitador = LimitadorSiigo()
+
+    def request(self, method: str, path: str, token: str | None = None, **kwargs) -> requests.Response:
+        """Con `token`, la llamada usa el token vigente del proceso; ante un 401 lo renueva y
+        reintenta UNA vez. Toda llamada pasa por el limitador y, si Siigo responde con límite,
+        se reintenta tras la pausa (hasta SIIGO_REINTENTOS_LIMITE veces)."""
+        if token and self.tokens is not None:
+            token = self.tokens.vigente() or token
+        renovado = False
+        intento = 0
+        while True:
+            resp = self._enviar(method, path, token, **kwargs)
+            if resp.status_code == 401 and token and self.tokens is not None and not renovado:
+                renovado = True
+                self.tokens.invalidar(token)
+                nuevo = self.tokens.vigente()
+                if nuevo and nuevo != token:
+                    token = nuevo
+                    continue
+            if not self._es_limite(resp):
+                self.limitador.exito()
+                return resp
+            if intento >= SIIGO_REINTENTOS_LIMITE:
+                return resp
+            intento += 1
+            self.limitador.limitado(_retry_after(resp))
+
+    @staticmethod
+    def _es_limite(resp: requests.Response) -> bool:
+        return resp.status_code == 429 or (resp.status_code >= 400 and "requests_limit" in resp.text)
+
+    def _enviar(self, method: str, path: str, token: str | None, **kwargs) -> requests.Response:
+        self.limitador.adquirir()
+        headers = dict(kwargs.pop("headers", None) or {})
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = f"{method.upper()} {path}"
+        t0 = time.perf_counter()
+        resp = None
+        try:
+            resp = self.session.request(method, f"{self.base_url}{path}", headers=headers, **kwargs)
+            return resp
+        finally:
+            self._registrar(endpoint, (time.perf_counter() - t0) * 1000, resp is None or resp.status_code >= 400)
+
+    def get(self, path: str, token: str | None = None, **kwargs) -> requests.Response:
+        return self.request("GET", path, token, **kwargs)
+
+    def post(self, path: str, token: str | None = None, **kwargs) -> requests.Response:
+        return self.request("POST", path, token, **kwargs)
+
+    def _registrar(self, endpoint: str, ms: float, error: bool) -> None:
+        with self._lock:
+            s = self._stats.setdefault(endpoint, {"llamadas": 0, "errores": 0, "ms_total": 0.0, "ms_max": 0.0})
+            s["llamadas"] += 1
+            s["errores"] += int(error)
+            s["ms_total"] += ms
+            s["ms_max"] = max(s["ms_max"], ms)
+        _registrar_metrica(f"Siigo {endpoint} (ms)", ms)
+
+    def reporte(self) -> pd.DataFrame:
+        with self._lock:
+            filas = [
+                {"endpoint": k, "llamadas": s["llamadas"], "errores": s["errores"],
+                 "ms promedio": round(s["ms_total"] / s["llamadas"], 1), "ms máx": round(s["ms_max"], 1)}
+                for k, s in sorted(self._stats.items())
+            ]
+        return pd.DataFrame(filas, columns=["endpoint", "llamadas", "errores", "ms promedio", "ms máx"])
+
+
+@st.cache_resource(show_spinner=False)
+def _siigo_client() -> SiigoClient:
+    """Un cliente (y un pool de conexiones) por proceso, compartido por sesiones y corridas."""
+    cfg = st.secrets.get("siigo", {})
+    cliente = SiigoClient(timeout=(float(cfg.get("connect_timeout_s", 5)), float(cfg.get("timeout_s", 30))))
+    cliente.limitador = LimitadorSiigo(tasa=float(cfg.get("rate_rps", 1.5)), tasa_max=float(cfg.get("rate_max_rps", 5.0)))
+    cliente.tokens = SiigoTokenManager(cliente, {
+        "username": st.secrets["siigo"]["username"],
+        "access_key": st.secrets["siigo"]["access_key"],
+    })
+    return cliente
 
 
+def obtain_token() -> str | None:
+    """
+    Token de Siigo (credenciales en st.secrets["siigo"]["username"] y ["access_key"]).
+    Se reutiliza el vigente del proceso; solo se pide uno nuevo si no hay o está por vencer.
+    """
+    return _siigo_client().tokens.vigente()
 
 
-def verify_customer(access_token: str, customer_identification: str) -> bool:
-    API_CUSTOMERS_URL = f"https://api.siigo.com/v1/customers?identification={customer_identification}"
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Partner-Id": NOMBRE_DE_MI_APP
-    }
 
+
+
+
+
+def verify_customer(access_token: str, customer_identification: str) -> bool:
     try:
-        response = requests.get(API_CUSTOMERS_URL, headers=headers, timeout=30)
+        response = _siigo_client().get(
+            "/v1/customers", access_token, params={"identification": customer_identification}
+        )
         data = response.json()
 
         if response.status_code == 200:
@@ -1962,19 +3956,11 @@ def create_customer_siigo(access_token: str, customer_data: dict):
     Retorna: (True, response_json) o (False, detalle_error_str)
     NO hace fallback a Medellín.
     """
-    url = f"{SIIGO_BASE_URL}/v1/customers"
-
     if not access_token:
         return False, "Token de acceso inválido."
 
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Partner-Id": NOMBRE_DE_MI_APP
-    }
-
     try:
-        resp = requests.post(url, json=customer_data, headers=headers, timeout=30)
+        resp = _siigo_client().post("/v1/customers", access_token, json=customer_data)
 
         try:
             data = resp.json()
@@ -1994,16 +3980,8 @@ def create_customer_siigo(access_token: str, customer_data: dict):
 
 
 def create_invoice_siigo(access_token: str, invoice_data: dict):
-    API_URL = "https://api.siigo.com/v1/invoices"
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Partner-Id": NOMBRE_DE_MI_APP
-    }
-
     try:
-        response = requests.post(API_URL, json=invoice_data, headers=headers, timeout=30)
+        response = _siigo_client().post("/v1/invoices", access_token, json=invoice_data)
         data = response.json()
 
         if response.status_code == 201:
@@ -2055,18 +4033,12 @@ def get_next_invoice_number(access_token: str) -> int | None:
         print("ERROR: access_token vacío al pedir el consecutivo de factura.")
         return None
 
-    url = f"{SIIGO_BASE_URL}/v1/invoices"
     params = {
         "page_size": 1,
         "sort": "-date"
     }
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Partner-Id": NOMBRE_DE_MI_APP
-    }
 
-    resp = requests.get(url, headers=headers, params=params, timeout=30)
+    resp = _siigo_client().get("/v1/invoices", access_token, params=params)
 
     try:
         data = resp.json()
@@ -2121,12 +4093,7 @@ def get_max_invoice_number(
         print("ERROR: access_token vacío al pedir el máximo consecutivo.")
         return None
 
-    url = f"{SIIGO_BASE_URL}/v1/invoices"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Partner-Id": NOMBRE_DE_MI_APP
-    }
+    cliente = _siigo_client()
 
     page = 1
     max_num = None
@@ -2139,7 +4106,7 @@ def get_max_invoice_number(
         }
 
         try:
-            resp = requests.get(url, headers=headers, params=params, timeout=30)
+            resp = cliente.get("/v1/invoices", access_token, params=params)
             try:
                 data = resp.json()
             except json.JSONDecodeError:
@@ -2204,6 +4171,222 @@ def get_max_invoice_number(
 
 
 
+# ======================= DIRECTORIO LOCAL DE CLIENTES SIIGO =======================
+# En vez de un GET /v1/customers por ingreso, se trae el directorio de clientes de Siigo por
+# páginas y se guarda en disco (solo las identificaciones). Cada corrida lo actualiza de forma
+# incremental (clientes creados desde la última sincronización) y pregunta por conjunto.
+SIIGO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".dash_cache", "siigo")
+SIIGO_CLIENTES_PATH = os.path.join(SIIGO_DIR, "clientes.json")
+SIIGO_CLIENTES_RESYNC_DIAS = 7     # cada cuánto se rehace el directorio completo
+SIIGO_PAGE_SIZE = 100
+
+
+@st.cache_resource(show_spinner=False)
+def _siigo_directorio() -> dict:
+    """Identificaciones de clientes que existen en Siigo, compartidas por el proceso."""
+    d = {"lock": threading.Lock(), "ids": set(), "sync": None, "completo": None}
+    try:
+        with open(SIIGO_CLIENTES_PATH, encoding="utf-8") as f:
+            data = json.load(f)
+        d.update(ids=set(data.get("ids") or []), sync=data.get("sync"), completo=data.get("completo"))
+    except Exception:
+        pass
+    return d
+
+
+def _guardar_directorio_siigo(d: dict) -> None:
+    try:
+        os.makedirs(SIIGO_DIR, exist_ok=True)
+        tmp = SIIGO_CLIENTES_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"ids": sorted(d["ids"]), "sync": d["sync"], "completo": d["completo"]}, f)
+        os.replace(tmp, SIIGO_CLIENTES_PATH)
+    except Exception as e:
+        print("⚠️ No se pudo guardar el directorio de clientes Siigo:", e)
+
+
+def _listar_clientes_siigo(access_token: str, desde: str | None = None) -> set | None:
+    """Identificaciones de /v1/customers (todas, o las creadas desde `desde`). None si falla."""
+    cliente = _siigo_client()
+    ids, page = set(), 1
+    while True:
+        params = {"page": page, "page_size": SIIGO_PAGE_SIZE}
+        if desde:
+            params["created_start"] = desde
+        try:
+            resp = cliente.get("/v1/customers", access_token, params=params)
+            data = resp.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"❌ ERROR listando clientes Siigo (page {page}):", e)
+            return None
+        if resp.status_code != 200:
+            print(f"❌ ERROR listando clientes Siigo (page {page}):", resp.status_code, data)
+            return None
+        items = data.get("results") or []
+        ids.update(_clean_id(c.get("identification")) for c in items if c.get("identification"))
+        total = (data.get("pagination") or {}).get("total_results")
+        if not items or len(items) < SIIGO_PAGE_SIZE or (total is not None and page * SIIGO_PAGE_SIZE >= int(total)):
+            return ids
+        page += 1
+
+
+def sincronizar_clientes_siigo(access_token: str) -> set | None:
+    """
+    Actualiza el directorio local: completo si no hay o tiene más de SIIGO_CLIENTES_RESYNC_DIAS,
+    si no solo lo creado desde la última sincronización (con un día de traslape).
+    Devuelve el conjunto de identificaciones o None si Siigo no respondió.
+    """
+    d = _siigo_directorio()
+    with d["lock"]:
+        t0 = time.perf_counter()
+        hoy = pd.Timestamp.now().normalize()
+        completo = d["completo"] and (hoy - pd.Timestamp(d["completo"])).days < SIIGO_CLIENTES_RESYNC_DIAS
+        desde = (pd.Timestamp(d["sync"]) - pd.Timedelta(days=1)).strftime("%Y-%m-%d") if completo and d["sync"] else None
+        nuevos = _listar_clientes_siigo(access_token, desde)
+        if nuevos is None:
+            return None
+        if desde is None:
+            d["ids"] = nuevos
+            d["completo"] = hoy.strftime("%Y-%m-%d")
+        else:
+            d["ids"] |= nuevos
+        d["sync"] = hoy.strftime("%Y-%m-%d")
+        _guardar_directorio_siigo(d)
+        _registrar_metrica("Siigo sincronización de clientes (s)", time.perf_counter() - t0)
+        return set(d["ids"])
+
+
+def registrar_cliente_siigo(identificacion: str) -> None:
+    """Agrega al directorio un cliente recién creado (sin esperar a que Siigo lo liste)."""
+    d = _siigo_directorio()
+    with d["lock"]:
+        d["ids"].add(_clean_id(identificacion))
+        _guardar_directorio_siigo(d)
+
+
+
+
+# ======================= CONSECUTIVO DE FACTURAS =======================
+# El último número emitido por tipo de documento se guarda en disco y se concilia con Siigo
+# pidiendo solo las facturas de ese documento creadas desde la última conciliación (una
+# página, normalmente). Los números se reservan en memoria al entregarlos: dos corridas del
+# mismo proceso nunca intentan el mismo número.
+SIIGO_CONSECUTIVOS_PATH = os.path.join(SIIGO_DIR, "consecutivos.json")
+
+
+@st.cache_resource(show_spinner=False)
+def _siigo_consecutivos() -> dict:
+    """docs: doc_id -> {"ultimo", "conciliado"} (persistido); siguiente / libres: reservas en memoria."""
+    d = {"lock": threading.RLock(), "docs": {}, "siguiente": {}, "libres": {}}
+    try:
+        with open(SIIGO_CONSECUTIVOS_PATH, encoding="utf-8") as f:
+            d["docs"] = json.load(f) or {}
+    except Exception:
+        pass
+    return d
+
+
+def _guardar_consecutivos(d: dict) -> None:
+    try:
+        os.makedirs(SIIGO_DIR, exist_ok=True)
+        tmp = SIIGO_CONSECUTIVOS_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(d["docs"], f)
+        os.replace(tmp, SIIGO_CONSECUTIVOS_PATH)
+    except Exception as e:
+        print("⚠️ No se pudo guardar el consecutivo de facturas:", e)
+
+
+def _max_consecutivo_desde(access_token: str, doc_id: int, desde: str) -> int | None:
+    """Mayor consecutivo entre las facturas del documento creadas desde `desde` (0 si no hay)."""
+    cliente = _siigo_client()
+    max_num, page = 0, 1
+    while True:
+        params = {"document_id": doc_id, "created_start": desde, "page": page, "page_size": SIIGO_PAGE_SIZE}
+        try:
+            resp = cliente.get("/v1/invoices", access_token, params=params)
+            data = resp.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"ERROR conciliando consecutivo (page {page}): {e}")
+            return None
+        if resp.status_code != 200:
+            print(f"ERROR conciliando consecutivo (page {page}): HTTP {resp.status_code}", data)
+            return None
+        items = data.get("results") or []
+        for inv in items:
+            try:
+                max_num = max(max_num, int(str(inv.get("consecutive") or inv.get("number"))))
+            except ValueError:
+                continue
+        total = (data.get("pagination") or {}).get("total_results")
+        if not items or len(items) < SIIGO_PAGE_SIZE or (total is not None and page * SIIGO_PAGE_SIZE >= int(total)):
+            return max_num
+        page += 1
+
+
+def conciliar_consecutivo(access_token: str, doc_id: int) -> int | None:
+    """
+    Último consecutivo emitido del documento. Con estado guardado, consulta solo lo creado desde
+    la última conciliación (un día de traslape); sin estado (primera vez), recorre con
+    get_max_invoice_number. Devuelve None si Siigo no respondió.
+    """
+    d = _siigo_consecutivos()
+    clave = str(doc_id)
+    with d["lock"]:
+        t0 = time.perf_counter()
+        doc = d["docs"].get(clave)
+        if doc:
+            desde = (pd.Timestamp(doc["conciliado"]) - pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+            visto = _max_consecutivo_desde(access_token, doc_id, desde)
+            ultimo = None if visto is None else max(int(doc["ultimo"]), visto)
+        else:
+            ultimo = get_max_invoice_number(access_token)
+        if ultimo is None:
+            return None
+        d["docs"][clave] = {"ultimo": int(ultimo), "conciliado": pd.Timestamp.now().strftime("%Y-%m-%d")}
+        d["siguiente"][clave] = max(d["siguiente"].get(clave, 0), int(ultimo) + 1)
+        d["libres"][clave] = {n for n in d["libres"].get(clave, set()) if n > int(ultimo)}
+        _guardar_consecutivos(d)
+        _registrar_metrica("Siigo conciliación de consecutivo (s)", time.perf_counter() - t0)
+        return int(ultimo)
+
+
+def reservar_consecutivo(doc_id: int) -> int:
+    """Entrega el próximo número libre del documento y lo deja reservado (requiere conciliar antes)."""
+    d = _siigo_consecutivos()
+    clave = str(doc_id)
+    with d["lock"]:
+        libres = d["libres"].setdefault(clave, set())
+        if libres:
+            n = min(libres)
+            libres.discard(n)
+            return n
+        n = max(d["siguiente"].get(clave, 0), int(d["docs"].get(clave, {}).get("ultimo", 0)) + 1)
+        d["siguiente"][clave] = n + 1
+        return n
+
+
+def confirmar_consecutivo(doc_id: int, numero: int) -> None:
+    """El número quedó usado en Siigo (factura creada, o ya existía)."""
+    d = _siigo_consecutivos()
+    clave = str(doc_id)
+    with d["lock"]:
+        doc = d["docs"].setdefault(clave, {"ultimo": 0, "conciliado": pd.Timestamp.now().strftime("%Y-%m-%d")})
+        doc["ultimo"] = max(int(doc["ultimo"]), int(numero))
+        _guardar_consecutivos(d)
+
+
+def liberar_consecutivo(doc_id: int, numero: int) -> None:
+    """La factura no se creó: el número vuelve a estar disponible (se usa antes que uno nuevo)."""
+    d = _siigo_consecutivos()
+    clave = str(doc_id)
+    with d["lock"]:
+        if int(numero) > int(d["docs"].get(clave, {}).get("ultimo", 0)):
+            d["libres"].setdefault(clave, set()).add(int(numero))
+
+
+
+
 # ======================= BUILDERS DESDE EXCEL =======================
 
 import re
@@ -2468,14 +4651,18 @@ def run_facturacion_masiva(
     st.write("=== Iniciando proceso de facturación MASIVA en Siigo ===")
 
     # =========================
-    # Config: tandas y checkpoint
+    # Config: checkpoint (el ritmo lo controla el limitador de SiigoClient)
     # =========================
-    MAX_FACTURAS_POR_TANDA = 40
-    SLEEP_SEGUNDOS = 60
     CHECKPOINT_CADA = 10
 
-    facturas_en_tanda = 0
     facturas_desde_checkpoint = 0
+    limitador = _siigo_client().limitador
+    limitadas_inicio = limitador.limitadas
+    t_inicio = time.monotonic()
+
+    def _ritmo() -> float:
+        """Facturas creadas por minuto en esta corrida."""
+        return ok_count / max((time.monotonic() - t_inicio) / 60, 1e-9)
 
     # =========================
     # Normalizaciones
@@ -2503,12 +4690,16 @@ def run_facturacion_masiva(
     if not token:
         st.error("ERROR CRÍTICO: No se pudo obtener el token de autenticación. No se puede continuar.")
         return
+    st.caption(
+        f"Token vigente por {_siigo_client().tokens.segundos_restantes() / 60:,.0f} min "
+        "(se renueva solo antes de vencer o si Siigo lo rechaza)."
+    )
 
     # =========================
     # 2) Consecutivo
     # =========================
-    st.write("2️⃣ Calculando máximo número de factura en Siigo (recorriendo varias páginas)...")
-    last_number = get_max_invoice_number(token, max_pages=30)
+    st.write("2️⃣ Conciliando el consecutivo de facturas con Siigo...")
+    last_number = conciliar_consecutivo(token, doc_id)
     if last_number is None:
         st.error("No se pudo calcular el consecutivo máximo de facturas en Siigo. Revisa logs.")
         return
@@ -2524,7 +4715,16 @@ def run_facturacion_masiva(
         )
         return
 
-    st.write(f"➡️ Primer número de factura a usar (max + 1): {current_number}")
+    st.write(f"➡️ Primer número de factura a usar (último + 1): {current_number}")
+
+    # Directorio de clientes Siigo (local, actualizado de forma incremental)
+    st.write("3️⃣ Sincronizando directorio de clientes de Siigo...")
+    clientes_siigo = sincronizar_clientes_siigo(token)
+    if clientes_siigo is None:
+        st.warning("⚠️ No se pudo sincronizar el directorio de clientes; se verificará cada cliente en Siigo.")
+    else:
+        st.write(f"➡️ {len(clientes_siigo):,} clientes en el directorio de Siigo.")
+    verificados = {}   # identificación -> existe (a lo sumo una consulta por cliente y corrida)
 
     # Índice de clientes por identificación
     cli_idx = {
@@ -2548,11 +4748,12 @@ def run_facturacion_masiva(
             base_folder = get_base_folder()
             fullpath = f"{base_folder}/{source_filename}"
 
-            df_file = _try_download_excel(fullpath)
+            df_file = _try_download_excel(fullpath, fresh=True)
             if df_file is None or df_file.empty:
                 st.warning(f"⚠️ No se pudo leer archivo de ingresos para checkpoint: {fullpath}")
                 df_file = None
             else:
+                df_file = df_file.copy()  # se va a modificar (Factura) y el original es compartido
                 if "ID_INGRESO" not in df_file.columns:
                     df_file["ID_INGRESO"] = pd.NA
                 if "Factura" not in df_file.columns:
@@ -2574,7 +4775,7 @@ def run_facturacion_masiva(
             df_file.to_excel(w, index=False, sheet_name="Ingresos")
         buf_up.seek(0)
 
-        dbx.files_upload(buf_up.read(), fullpath, mode=dropbox.files.WriteMode.overwrite)
+        _dbx_upload(buf_up.read(), fullpath)
         st.info(f"✅ CHECKPOINT guardado en Dropbox: {source_filename}")
 
     # =========================
@@ -2606,7 +4807,12 @@ def run_facturacion_masiva(
                 continue
 
             # 3) Verificar/crear cliente
-            exists = verify_customer(token, ident)
+            if ident not in verificados:
+                if clientes_siigo is not None:
+                    verificados[ident] = ident in clientes_siigo
+                else:
+                    verificados[ident] = verify_customer(token, ident)
+            exists = verificados[ident]
             if not exists:
                 st.write(f"Cliente {ident} no existe en Siigo. Creando...")
                 try:
@@ -2628,20 +4834,11 @@ def run_facturacion_masiva(
                     err_count += 1
                     continue
 
-                # ✅ retry verify (porque a veces Siigo demora en reflejar)
-                max_verify = 6
-                verified = False
-                for t in range(max_verify):
-                    time.sleep(1.5)
-                    if verify_customer(token, ident):
-                        verified = True
-                        break
-                if not verified:
-                    msg = f"Cliente {ident} se creó, pero no aparece aún en verify_customer tras reintentos."
-                    st.warning(msg)
-                    log_invoice_error(id_ingreso, msg)
-                    # OJO: no paramos; intentamos igual facturar (a veces factura pasa)
-                    # continue
+                # Creado: queda en el directorio de una vez (no se espera a que Siigo lo liste)
+                registrar_cliente_siigo(ident)
+                verificados[ident] = True
+                if clientes_siigo is not None:
+                    clientes_siigo.add(ident)
 
             # 4) Intentar crear factura
             intentos = 0
@@ -2649,9 +4846,10 @@ def run_facturacion_masiva(
 
             while intentos < max_intentos:
                 intentos += 1
-                numero_en_uso = current_number
+                numero_en_uso = reservar_consecutivo(doc_id)
 
                 if numero_en_uso > FACTURA_MAX_NUMERO - 1:
+                    liberar_consecutivo(doc_id, numero_en_uso)
                     st.error(f"❌ Límite legal alcanzado ({FACTURA_MAX_NUMERO - 1}).")
                     return
 
@@ -2668,6 +4866,7 @@ def run_facturacion_masiva(
                         casillero_actual=str(casillero_actual),
                     )
                 except Exception as e:
+                    liberar_consecutivo(doc_id, numero_en_uso)
                     err_msg = f"Error armando la factura para ingreso {id_ingreso}: {e}"
                     st.error(err_msg)
                     log_invoice_error(id_ingreso, err_msg)
@@ -2677,6 +4876,7 @@ def run_facturacion_masiva(
                 ok, err_msg = create_invoice_siigo(token, invoice_data)
 
                 if ok:
+                    confirmar_consecutivo(doc_id, numero_en_uso)
                     num_factura = str(numero_en_uso)
                     df_ing_pend.loc[idx, "Factura"] = num_factura
                     st.success(f"✅ Factura {num_factura} creada correctamente para ingreso {id_ingreso}")
@@ -2700,18 +4900,7 @@ def run_facturacion_masiva(
                         except Exception as e:
                             st.warning(f"⚠️ No se pudo guardar checkpoint: {e}")
                         facturas_desde_checkpoint = 0
-
-                    # =========================
-                    # ✅ Tandas de 40 + sleep 60s y retomar
-                    # =========================
-                    facturas_en_tanda += 1
-                    if facturas_en_tanda >= MAX_FACTURAS_POR_TANDA:
-                        st.warning(
-                            f"🟡 Se alcanzaron {MAX_FACTURAS_POR_TANDA} facturas. "
-                            f"Pausando {SLEEP_SEGUNDOS}s para evitar rate limit..."
-                        )
-                        time.sleep(SLEEP_SEGUNDOS)
-                        facturas_en_tanda = 0
+                        st.caption(f"Ritmo: {_ritmo():,.1f} facturas/min · tasa del limitador {limitador.tasa:,.2f} llamadas/s")
 
                     break  # sale del while de intentos
 
@@ -2732,11 +4921,11 @@ def run_facturacion_masiva(
                                 f"⚠️ Ajuste por redondeo: payments.value -> {siigo_total}. "
                                 "Reintentando la MISMA factura..."
                             )
-                            time.sleep(1.0)
                 
                             # ✅ Reintenta inmediatamente con el invoice_data ajustado
                             ok2, err2 = create_invoice_siigo(token, invoice_data)
                             if ok2:
+                                confirmar_consecutivo(doc_id, numero_en_uso)
                                 num_factura = str(numero_en_uso)
                                 df_ing_pend.loc[idx, "Factura"] = num_factura
                                 st.success(f"✅ Factura {num_factura} creada correctamente (ajuste redondeo) para ingreso {id_ingreso}")
@@ -2757,16 +4946,6 @@ def run_facturacion_masiva(
                                         st.warning(f"⚠️ No se pudo guardar checkpoint: {e}")
                                     facturas_desde_checkpoint = 0
                 
-                                # tandas de 40
-                                facturas_en_tanda += 1
-                                if facturas_en_tanda >= MAX_FACTURAS_POR_TANDA:
-                                    st.warning(
-                                        f"🟡 Se alcanzaron {MAX_FACTURAS_POR_TANDA} facturas. "
-                                        f"Pausando {SLEEP_SEGUNDOS}s para evitar rate limit..."
-                                    )
-                                    time.sleep(SLEEP_SEGUNDOS)
-                                    facturas_en_tanda = 0
-                
                                 break  # ✅ salimos del while intentos (ya quedó ok)
                 
                             else:
@@ -2779,21 +4958,29 @@ def run_facturacion_masiva(
 
                 
 
-                # si el número ya existe, probar el siguiente
+                # si el número ya existe (se facturó por fuera de esta app), se reconcilia una vez
+                # con Siigo y se salta directo al último real, en vez de probar de uno en uno
                 if "already_exists" in texto_err or "number already exists" in texto_err:
-                    st.warning(f"⚠️ El número {numero_en_uso} ya existe. Probando siguiente...")
-                    current_number = numero_en_uso + 1
+                    confirmar_consecutivo(doc_id, numero_en_uso)
+                    ultimo = conciliar_consecutivo(token, doc_id)
+                    st.warning(
+                        f"⚠️ El número {numero_en_uso} ya existe. Consecutivo conciliado con Siigo: "
+                        f"{ultimo if ultimo is not None else 'sin respuesta'}."
+                    )
                     continue
 
-                # ✅ si rate limit / servicio caído, esperar y reintentar
+                liberar_consecutivo(doc_id, numero_en_uso)
+
+                # ✅ si rate limit / servicio caído, esperar y reintentar (SiigoClient ya reintentó
+                # los límites; aquí se alarga la pausa del limitador compartido)
                 if "requests_limit" in texto_err or "Rate limit" in texto_err:
-                    st.warning("⚠️ Rate limit. Esperando 6s y reintentando...")
-                    time.sleep(6)
+                    espera = limitador.limitado()
+                    st.warning(f"⚠️ Rate limit. Reintentando en {espera:,.0f}s (tasa {limitador.tasa:,.2f} llamadas/s)...")
                     continue
 
                 if "product_service" in texto_err:
-                    st.warning("⚠️ Siigo Products service caído. Esperando 20s y reintentando...")
-                    time.sleep(20)
+                    espera = limitador.backoff(intentos)
+                    st.warning(f"⚠️ Siigo Products service caído. Se esperó {espera:,.0f}s; reintentando...")
                     continue
 
                 err_count += 1
@@ -2817,6 +5004,11 @@ def run_facturacion_masiva(
     st.write("=== Proceso de facturación finalizado ===")
     st.write(f"✔️ Facturas creadas: {ok_count}")
     st.write(f"⚠️ Errores: {err_count}")
+    st.write(f"🚀 Ritmo: {_ritmo():,.1f} facturas/min (límites del API en la corrida: {limitador.limitadas - limitadas_inicio})")
+    if ok_count:
+        _registrar_metrica("Siigo facturas/min por corrida", _ritmo())
+    with st.expander("⏱️ Latencia de Siigo por endpoint (acumulado del proceso)"):
+        st.dataframe(_siigo_client().reporte(), use_container_width=True, hide_index=True)
 
     # ✅ Guardado final (otra vez) por si no alcanzó checkpoint exacto
     try:
@@ -2875,150 +5067,4 @@ if st.button("🚀 Realizar facturación", use_container_width=True):
 # ——————————————————————————————
 # 9) Todas las gráficas al final con numeración corregida
 # ——————————————————————————————
-
-# 9.1️⃣ Evolución del saldo reportado (#4)
-st.header("4️⃣ Evolución del saldo reportado")
-try:
-    df_tot = df[df['Tipo']=='Total']
-    if df_tot.empty:
-        st.info("Aún no hay movimientos totales para mostrar.")
-    else:
-        df_tot = df_tot.copy()
-        # asegurar tipos
-        df_tot['Fecha de Carga'] = pd.to_datetime(df_tot['Fecha de Carga'], errors='coerce')
-        df_tot['Monto'] = pd.to_numeric(df_tot['Monto'], errors='coerce')
-    
-        # tomar las 7 fechas de carga más recientes (distintas)
-        fechas_recientes = (
-            df_tot['Fecha de Carga']
-            .dt.normalize()            # sólo la fecha (sin hora)
-            .dropna()
-            .drop_duplicates()
-            .sort_values(ascending=False)
-            .head(7)
-        )
-        # filtrar al conjunto de esas 7 fechas
-        df_tot = df_tot[df_tot['Fecha de Carga'].dt.normalize().isin(set(fechas_recientes))]
-        # ordenar por fecha para que la línea salga prolija
-        df_tot = df_tot.sort_values('Fecha de Carga')
-    
-        fig, ax = plt.subplots(figsize=(8,4))
-    
-        # 1) línea gris de fondo
-        ax.plot(df_tot['Fecha de Carga'], df_tot['Monto'],
-                linestyle='-', color='lightgrey', linewidth=1)
-    
-        # 2) marcadores individuales coloreados
-        for _, row in df_tot.iterrows():
-            pt_color = 'green' if row['Monto'] >= 0 else 'red'
-            ax.scatter(row['Fecha de Carga'], row['Monto'], color=pt_color, s=50, zorder=3)
-    
-        ax.set_title("Conciliación por día")
-        ax.set_xlabel("Fecha de Carga")
-        ax.set_ylabel("Saldo")
-        ax.yaxis.set_major_formatter(mtick.StrMethodFormatter('${x:,.0f}'))
-    
-        # 3) anotaciones desplazadas
-        for _, row in df_tot.iterrows():
-            ann_color = 'green' if row['Monto'] >= 0 else 'red'
-            label = f"{row['Fecha de Carga'].date()}\n${row['Monto']:,.0f}"
-            offset = 30 if row['Monto'] >= 0 else -30
-            ax.annotate(
-                label,
-                xy=(row['Fecha de Carga'], row['Monto']),
-                xytext=(0, offset),
-                textcoords="offset points",
-                fontsize=8,
-                ha='center',
-                color=ann_color
-            )
-    
-        col1, col2, col3 = st.columns([1, 2, 1])
-        with col2:
-            st.pyplot(fig)
-
-except Exception as e:
-    st.error(f"⚠️ Error sección Evolución del saldo: {e}")
-
-# 9.2️⃣ Cantidad de compras (últimos 7 días) (#5)
-st.header("5️⃣ Cantidad de compras (últimos 7 días)")
-try:
-    df_eg2 = df[df['Tipo']=='Egreso'].copy()
-    if df_eg2.empty:
-        st.info("Aún no hay compras para el cálculo de los últimos 7 días.")
-    else:
-        df_eg2['Fecha'] = pd.to_datetime(df_eg2['Fecha'])
-        max_f = df_eg2['Fecha'].max()
-        min_f = max_f - pd.Timedelta(days=6)
-        conteo = df_eg2[(df_eg2['Fecha'] >= min_f) & (df_eg2['Fecha'] <= max_f)].groupby('Fecha').size()
-        if conteo.empty:
-            st.info("No hay compras en los últimos 7 días.")
-        else:
-            fig2, ax2 = plt.subplots(figsize=(8,4))
-            ax2.plot(conteo.index, conteo.values, marker='o', color='green')
-            ax2.set_title(f"Cantidad de compras: {min_f.date()} al {max_f.date()}")
-            ax2.set_xlabel("Fecha")
-            ax2.set_ylabel("Cantidad de compras")
-            ax2.set_ylim(0, conteo.max() + 5)
-            for fecha, val in conteo.items():
-                ax2.text(fecha, val + 0.5, str(val), fontsize=8, ha='center', color='green')
-            with st.columns([1,2,1])[1]:
-                st.pyplot(fig2)
-except Exception as e:
-    st.error(f"⚠️ Error sección Cantidad de compras: {e}")
-
-# 9.3️⃣ Valor total de compras (últimos 7 días) (#6)
-st.header("6️⃣ Valor total de compras (últimos 7 días)")
-try:
-    if df_eg2.empty:
-        st.info("Sin datos de egresos para valores totales.")
-    else:
-        suma = df_eg2[(df_eg2['Fecha'] >= min_f) & (df_eg2['Fecha'] <= max_f)].groupby('Fecha')['Monto'].sum()
-        if suma.empty or pd.isna(suma.max()):
-            st.info("No hay valor de compras en los últimos 7 días.")
-        else:
-            fig3, ax3 = plt.subplots(figsize=(8,4))
-            ax3.plot(suma.index, suma.values, marker='o', color='green')
-            ax3.set_title(f"Valor de compras: {min_f.date()} al {max_f.date()}")
-            ax3.set_xlabel("Fecha")
-            ax3.set_ylabel("Monto acumulado")
-            ax3.yaxis.set_major_formatter(mtick.StrMethodFormatter('${x:,.0f}'))
-            ax3.set_ylim(0, suma.max() * 1.25)
-            rango_s = suma.max() - suma.min() if suma.max() != suma.min() else suma.max()
-            for fecha, val in suma.items():
-                desplaz = max(rango_s * 0.1, suma.max() * 0.05)
-                ax3.text(fecha, val + desplaz, f"${val:,.0f}", fontsize=8, ha='center', color='green')
-            with st.columns([1,2,1])[1]:
-                st.pyplot(fig3)
-except Exception as e:
-    st.error(f"⚠️ Error sección Valor total de compras: {e}")
-
-# 9.4️⃣ Ingresos últimos 7 días (#7)
-st.header("7️⃣ Ingresos últimos 7 días")
-try:
-    df_in2 = df[df['Tipo']=='Ingreso'].copy()
-    if df_in2.empty:
-        st.info("Aún no tenemos movimientos de ingresos.")
-    else:
-        df_in2['Fecha'] = pd.to_datetime(df_in2['Fecha'])
-        max_i = df_in2['Fecha'].max()
-        min_i = max_i - pd.Timedelta(days=6)
-        suma_i = df_in2[(df_in2['Fecha'] >= min_i) & (df_in2['Fecha'] <= max_i)].groupby('Fecha')['Monto'].sum()
-        if suma_i.empty or pd.isna(suma_i.max()):
-            st.info("Aún no tenemos ingresos en los últimos 7 días.")
-        else:
-            fig4, ax4 = plt.subplots(figsize=(8,4))
-            ax4.plot(suma_i.index, suma_i.values, marker='o', color='green')
-            ax4.set_title(f"Ingresos: {min_i.date()} al {max_i.date()}")
-            ax4.set_xlabel("Fecha")
-            ax4.set_ylabel("Monto acumulado")
-            ax4.yaxis.set_major_formatter(mtick.StrMethodFormatter('${x:,.0f}'))
-            ax4.set_ylim(0, suma_i.max() * 1.2)
-            rng_i = suma_i.max() - suma_i.min() if suma_i.max() != suma_i.min() else suma_i.max()
-            for fecha, val in suma_i.items():
-                d = max(rng_i * 0.1, suma_i.max() * 0.05)
-                ax4.text(fecha, val + d, f"${val:,.0f}", fontsize=8, ha='center', color='green')
-            with st.columns([1,2,1])[1]:
-                st.pyplot(fig4)
-except Exception as e:
-    st.error(f"⚠️ Error sección Ingresos últimos 7 días: {e}")
+_seccion_graficas()
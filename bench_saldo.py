@@ -0,0 +1,103 @@
+"""
+Medición del saldo en vivo (_pendientes_saldo) sobre datos sintéticos.
+
+Compara el cálculo anterior (set de 'Orden' + iterrows por fila aprobada) con el actual
+(índice de 'Orden' cacheado por versión + anti-join con get_indexer). Las funciones
+actuales se toman tal cual de Dash.py (sin levantar Streamlit ni Dropbox).
+
+Uso:  python bench_saldo.py            (o: python bench_saldo.py > bench_output.txt)
+"""
+import ast
+import time
+
+import numpy as np
+import pandas as pd
+
+TAMANOS = [(100, 10_000), (1_000, 100_000), (10_000, 1_000_000)]  # (consignaciones, filas histórico)
+REPETICIONES = 5
+
+
+def _funciones_de_dash(nombres: list[str], extra: dict) -> dict:
+    """Compila solo esas funciones de Dash.py (sin decoradores) en un namespace propio."""
+    with open("Dash.py", encoding="utf-8") as f:
+        arbol = ast.parse(f.read())
+    defs = [n for n in arbol.body if isinstance(n, ast.FunctionDef) and n.name in nombres]
+    for n in defs:
+        n.decorator_list = []
+    ns = {"pd": pd, "np": np, **extra}
+    exec(compile(ast.Module(body=defs, type_ignores=[]), "Dash.py", "exec"), ns)
+    return ns
+
+
+def _datos(n_cons: int, n_hist: int, rng: np.random.Generator):
+    """Histórico con 'Orden' y consignaciones/retiros con la mitad aprobada (un cuarto ya cargado)."""
+    ids = np.array([f"Consignacion{i}" for i in range(n_cons)], dtype=object)
+    ids_ret = np.array([f"retiro{i}" for i in range(n_cons // 2)], dtype=object)
+    cargadas = np.concatenate([ids[: n_cons // 4], ids_ret[: n_cons // 8]])
+    orden = np.array([f"N{i}" for i in range(n_hist - len(cargadas))] + list(cargadas), dtype=object)
+    hist = pd.DataFrame({"Orden": rng.permutation(orden)})
+    estados = np.where(rng.random(n_cons) < 0.5, "aprobada", "pendiente")
+    cons = pd.DataFrame({
+        "ID": ids, "Descripcion": "x", "Monto": rng.integers(1, 10_000_000, n_cons).astype(float), "Estado": estados,
+    })
+    ret = pd.DataFrame({
+        "ID retiro": ids_ret, "Descripcion": "x",
+        "Egreso retiro": rng.integers(1, 10_000_000, len(ids_ret)).astype(float), "Estado": estados[: len(ids_ret)],
+    })
+    return hist, cons, ret
+
+
+def _saldo_anterior(df_hist: pd.DataFrame, dcons: pd.DataFrame, dret: pd.DataFrame, norm_monto):
+    """El cálculo anterior a la vectorización (set reconstruido en cada render + iterrows)."""
+    ordenes = set(df_hist["Orden"].astype(str).str.strip())
+    ing = egr = 0.0
+    ap = dcons[dcons["Estado"].astype(str).str.strip().str.lower() == "aprobada"]
+    for _, r in ap.iterrows():
+        if str(r.get("ID", "")).strip() not in ordenes:
+            ing += norm_monto(r.get("Monto")) or 0
+    apr = dret[dret["Estado"].astype(str).str.strip().str.lower() == "aprobada"]
+    for _, r in apr.iterrows():
+        if str(r.get("ID retiro", "")).strip() not in ordenes:
+            egr += norm_monto(r.get("Egreso retiro")) or 0
+    return ing, egr
+
+
+def _saldo_actual(ordenes: pd.Index, dcons: pd.DataFrame, dret: pd.DataFrame, pendientes_de):
+    detalle = pd.concat([
+        pendientes_de(dcons, "ID", "Monto", "Consignación", ordenes),
+        pendientes_de(dret, "ID retiro", "Egreso retiro", "Retiro", ordenes),
+    ], ignore_index=True)
+    montos = detalle["Monto"].to_numpy(dtype=float)
+    es_ing = (detalle["Tipo"] == "Consignación").to_numpy()
+    return float(np.sum(montos[es_ing])), float(np.sum(montos[~es_ing]))
+
+
+def _mejor_ms(fn, *args) -> tuple[float, object]:
+    mejor, res = float("inf"), None
+    for _ in range(REPETICIONES):
+        t = time.perf_counter()
+        res = fn(*args)
+        mejor = min(mejor, time.perf_counter() - t)
+    return mejor * 1000, res
+
+
+def main() -> None:
+    hist_actual: dict = {}
+    ns = _funciones_de_dash(
+        ["_norm_monto", "_pendientes_de", "_ordenes_historico"],
+        {"_load_sheet": lambda path, version, sheet: hist_actual["df"]},
+    )
+    rng = np.random.default_rng(0)
+    print(f"{'consignaciones':>14} {'histórico':>10} {'antes (ms)':>11} {'ahora (ms)':>11} {'índice (ms)':>12}  iguales")
+    for n_cons, n_hist in TAMANOS:
+        hist, cons, ret = _datos(n_cons, n_hist, rng)
+        hist_actual["df"] = hist
+        t_indice, ordenes = _mejor_ms(ns["_ordenes_historico"], "", "", "")  # una vez por versión
+        t_antes, r_antes = _mejor_ms(_saldo_anterior, hist, cons, ret, ns["_norm_monto"])
+        t_ahora, r_ahora = _mejor_ms(_saldo_actual, ordenes, cons, ret, ns["_pendientes_de"])
+        iguales = np.allclose(r_antes, r_ahora)
+        print(f"{n_cons:>14,} {n_hist:>10,} {t_antes:>11.1f} {t_ahora:>11.1f} {t_indice:>12.1f}  {iguales}")
+
+
+if __name__ == "__main__":
+    main()